@@ -1,15 +1,34 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from routes.import_routes import router as import_router
-from routes.post_routes import router as post_router
+from routes.post_routes import router as post_router, resume_posting, stop_posting
 from routes.custom_post_route import router as custom_post_router
 from routes.get_bulk_url_route import router as bulk_url_router
 from routes.check_listings_routes import router as listings_router
 from routes.delete_listings_routes import router as delete_router
 from routes.subscription_routes import router as subscription_router
+from routes.status_routes import router as status_router
+from routes.analytics_routes import router as analytics_router
+from routes.relist_routes import router as relist_router
+from utils.http_client import start_http_client, close_http_client
+from utils.posting_store import posting_store
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled upstream client for the whole app
+    await start_http_client()
+    # Pick up queued listings from before the last restart
+    await posting_store.start()
+    await resume_posting()
+    yield
+    # Workers first, so nothing writes to the store or the session while they close
+    await stop_posting()
+    await posting_store.close()
+    await close_http_client()
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -29,6 +48,9 @@ app.include_router(bulk_url_router, prefix="/api")
 app.include_router(listings_router, prefix="/api"   )
 app.include_router(delete_router, prefix="/api"   )
 app.include_router(subscription_router, prefix="/api")
+app.include_router(status_router, prefix="/api")
+app.include_router(analytics_router, prefix="/api")
+app.include_router(relist_router, prefix="/api")
 
 if __name__ == "__main__":
     import uvicorn
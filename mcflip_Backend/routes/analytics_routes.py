@@ -0,0 +1,40 @@
+from fastapi import APIRouter, HTTPException, Header, Query, Depends
+import aiohttp
+import time
+from datetime import datetime, timezone
+from typing import Optional
+from utils.accounts import resolve_account_id
+from utils.http_client import get_http_session
+from utils.inventory import inventory
+from utils.pagination import PageFetchError
+
+router = APIRouter()
+
+# Inventory analytics over the shared snapshot. The listings are fetched (or delta-synced)
+# through the inventory cache, then every figure is computed on the snapshot's NumPy
+# columns, which are only rebuilt when the snapshot changed.
+@router.get("/inventory-analytics")
+async def inventory_analytics(
+    apiKey: str = Header(...),
+    apiSecret: str = Header(...),
+    older_than_hours: Optional[float] = Query(None, ge=0),   # also break down listings older than this
+    session: aiohttp.ClientSession = Depends(get_http_session)
+):
+    """Age buckets, price quantiles and per-category counts of the onsale inventory."""
+    account_id = await resolve_account_id(session, apiKey, apiSecret)
+    if not account_id:
+        raise HTTPException(status_code=400, detail="Failed to get account ID")
+
+    try:
+        snapshot = await inventory.get(session, apiKey, apiSecret, account_id)
+    except PageFetchError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    started = time.perf_counter()
+    columns = snapshot.columns()
+    now = datetime.now(timezone.utc).timestamp()
+    older_than = older_than_hours * 3600 if older_than_hours is not None else None
+    result = columns.analytics(now, older_than)
+    result["older_than_hours"] = older_than_hours
+    result["compute_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return result
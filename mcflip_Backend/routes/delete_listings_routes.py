@@ -2,11 +2,19 @@ from fastapi import APIRouter, HTTPException, Depends, Request
 import aiohttp
 import asyncio
 import json
-import pyotp
-import base64
+import math
 import os
 import logging
 from datetime import datetime, timezone
+from utils.accounts import resolve_account_id
+from utils.http_client import get_http_session
+from utils.inventory import DELTA_SYNC_WINDOW, inventory
+from utils.inventory_columns import InventoryColumns
+from utils.jobs import JobRegistry
+from utils.pagination import LISTING_PAGE_SIZE, PageFetchError
+from utils.auth import tenant_id_for
+from utils.rate_governor import get_governor
+from utils.upstream import RetryPolicy, upstream_request
 
 # Initialize router
 router = APIRouter()
@@ -18,144 +26,269 @@ PROFILE_ENDPOINT = f"{BASE_URL}/account/me/profile"
 
 # Constants
 DELETE_THRESHOLD_HOURS = 0  # Default, will be overridden by request
-MAX_RETRIES = 2
+MAX_RETRIES = 3
+SWEEP_POLICY = RetryPolicy(attempts=MAX_RETRIES, deadline=120)
 DELAY_BETWEEN_OPERATIONS = 0
+DELETE_WORKERS = int(os.getenv("DELETE_WORKERS", "4"))
+MAX_DELETE_WORKERS = 16
+DELETE_QUEUE_SIZE = 200
+DELETE_MODES = ("stream", "snapshot")
+DELETE_JOB_CONCURRENCY = int(os.getenv("DELETE_JOB_CONCURRENCY", "2"))
+
+# Background deletion sweeps, at most DELETE_JOB_CONCURRENCY running at once
+delete_jobs = JobRegistry(concurrency=DELETE_JOB_CONCURRENCY)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
-# Function to generate authentication headers
-def get_auth_headers(api_key: str, api_secret: str, content_type="application/json"):
-    try:
-        base64.b32decode(api_secret)  # Validate API_SECRET format
-    except:
-        api_secret = base64.b32encode(api_secret.encode()).decode()
-
-    totp = pyotp.TOTP(api_secret)  # Generate one-time password (OTP)
-    otp = totp.now()
-    print("Generated OTP:", otp)
-
-    headers = {
-        "Authorization": f"GFAPI {api_key}:{otp}",
-        "Content-Type": content_type
-    }
-    return headers
-
-# Function to make API requests with retries
-async def api_request(session, method, url, headers, **kwargs):
-    for attempt in range(MAX_RETRIES):
-        try:
-            async with session.request(method, url, headers=headers, **kwargs) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    error_data = await response.json()
-                    logging.error(f"API Error: {error_data}")
-                    if "Invalid api otp" in str(error_data):
-                        headers = get_auth_headers(headers["Authorization"].split(" ")[1].split(":")[0], headers["Authorization"].split(" ")[1].split(":")[1])
-                        await asyncio.sleep(1)
-                    elif "Too many attempts" in str(error_data):
-                        await asyncio.sleep(60)
-                    else:
-                        break
-        except Exception as e:
-            logging.error(f"Request error: {str(e)}")
-            if attempt == MAX_RETRIES - 1:
-                return None
-        await asyncio.sleep(2 ** attempt)
+# Function to make API requests through the shared upstream client
+# `creds` is (api_key, api_secret); returns the response data, or None on failure.
+async def api_request(session, method, url, creds, content_type="application/json", **kwargs):
+    result = await upstream_request(session, method, url, creds, content_type, policy=SWEEP_POLICY, **kwargs)
+    if result.ok:
+        return result.data
+    logging.error(f"API Error ({result.error}): {result.data}")
     return None
 
 # Function to get account ID
-async def get_my_account_id(session, headers):
-    data = await api_request(session, "GET", PROFILE_ENDPOINT, headers=headers)
-    if data and "data" in data:
-        return data["data"]["owner"]
-    return None
-
-# Function to get on-sale listings
-async def get_my_listings(session, headers, account_id, start_param):
-    params = {"owner": account_id, "start": start_param, "limit": 100, "status": "onsale"}
-    data = await api_request(session, "GET", LISTINGS_ENDPOINT, headers=headers, params=params)
-    return data["data"] if data and "data" in data else []
+async def get_my_account_id(session, creds):
+    return await resolve_account_id(session, *creds)
 
 # Function to change a listing to draft
-async def change_listing_to_draft(session, headers, listing_id):
+async def change_listing_to_draft(session, creds, listing_id):
     update = [{"op": "replace", "path": "/status", "value": "draft"}]
-    patch_headers = {**headers, "Content-Type": "application/json-patch+json"}
-    data = await api_request(session, "PATCH", f"{LISTINGS_ENDPOINT}/{listing_id}", headers=patch_headers, json=update)
+    data = await api_request(session, "PATCH", f"{LISTINGS_ENDPOINT}/{listing_id}", creds,
+                             content_type="application/json-patch+json", json=update)
     return data and data.get("status") == "SUCCESS"
 
 # Function to delete a listing
-async def delete_listing(session, headers, listing_id):
-    data = await api_request(session, "DELETE", f"{LISTINGS_ENDPOINT}/{listing_id}", headers=headers)
+async def delete_listing(session, creds, listing_id):
+    data = await api_request(session, "DELETE", f"{LISTINGS_ENDPOINT}/{listing_id}", creds)
     return data and data.get("status") == "SUCCESS"
 
-# Function to process and delete old listings
-async def process_old_onsale_listings(session, headers, account_id, delete_threshold_hours):
-    start_param = 0
-    drafted_count, deleted_count = 0, 0
-    failed_draft_count, failed_delete_count = 0, 0
+# Live counters of a deletion sweep
+class DeleteProgress:
+    def __init__(self):
+        self.scanned = 0
+        self.matched = 0
+        self.drafted = 0
+        self.deleted = 0
+        self.failed_draft = 0
+        self.failed_delete = 0
 
-    logging.info(f"Starting deletion of listings older than {delete_threshold_hours} hours")
+    def as_dict(self):
+        return {
+            "drafted": self.drafted,
+            "deleted": self.deleted,
+            "failed_draft": self.failed_draft,
+            "failed_delete": self.failed_delete,
+            "scanned": self.scanned,
+            "matched": self.matched
+        }
 
-    while True:
-        listings = await get_my_listings(session, headers, account_id, start_param)
-        if not listings:
-            break
+# Function to draft then delete one listing
+async def retire_listing(session, creds, listing_id, progress):
+    if await change_listing_to_draft(session, creds, listing_id):
+        progress.drafted += 1
+        inventory.discard(creds[0], [listing_id])
+        logging.info(f"Listing {listing_id} changed to draft")
+        await asyncio.sleep(DELAY_BETWEEN_OPERATIONS)
         
-        current_time = datetime.now(timezone.utc)
-        for listing in listings:
-            created_time = datetime.strptime(listing["created"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
-            age_hours = (current_time - created_time).total_seconds() 
+        if await delete_listing(session, creds, listing_id):
+            progress.deleted += 1
+            logging.info(f"Deleted listing {listing_id}")
+        else:
+            progress.failed_delete += 1
+            logging.error(f"Failed to delete listing {listing_id}")
+    else:
+        progress.failed_draft += 1
+        logging.error(f"Failed to change listing {listing_id} to draft")
+    
+    await asyncio.sleep(DELAY_BETWEEN_OPERATIONS)
+
+# Function to stream the listings a sweep should retire
+# mode="stream" reads the whole shared inventory snapshot (refreshed first if needed);
+# mode="snapshot" collects only the candidates (oldest first, scan stopped at the age
+# cutoff). Either way the upstream walk is finished before the caller mutates anything,
+# since deleting from the live search would shift its offsets under the walk.
+# Counts scanned/matched on `progress`.
+async def iter_old_listings(session, creds, account_id, delete_threshold_hours, progress, mode="stream"):
+    async def candidate_pages():
+        if mode == "snapshot":
+            cutoff = datetime.now(timezone.utc).timestamp() - delete_threshold_hours
+            yield await inventory.older_than(session, creds[0], creds[1], account_id, cutoff)
+            return
+        snapshot = await inventory.get(session, creds[0], creds[1], account_id)
+        yield snapshot.values()
 
+    seen = set()
+    async for page in candidate_pages():
+        current_time = datetime.now(timezone.utc).timestamp()
+        for listing in page:
+            if listing["id"] in seen:
+                continue
+            seen.add(listing["id"])
+            progress.scanned += 1
+            age_hours = current_time - listing["created_ts"]
             if age_hours > delete_threshold_hours:
+                progress.matched += 1
                 logging.info(f"Processing listing {listing['id']} - Age: {age_hours:.2f} hours")
-                
-                if await change_listing_to_draft(session, headers, listing["id"]):
-                    drafted_count += 1
-                    logging.info(f"Listing {listing['id']} changed to draft")
-                    await asyncio.sleep(DELAY_BETWEEN_OPERATIONS)
-                    
-                    if await delete_listing(session, headers, listing["id"]):
-                        deleted_count += 1
-                        logging.info(f"Deleted listing {listing['id']}")
-                    else:
-                        failed_delete_count += 1
-                        logging.error(f"Failed to delete listing {listing['id']}")
-                else:
-                    failed_draft_count += 1
-                    logging.error(f"Failed to change listing {listing['id']} to draft")
-                
-                await asyncio.sleep(DELAY_BETWEEN_OPERATIONS)
-        
-        start_param += 100
+                yield listing
+
+# Function to process and delete old listings
+# The inventory scan feeds a bounded queue and `workers` coroutines run the
+# draft -> delete steps concurrently; the account's rate governor sets the pace.
+async def process_old_onsale_listings(session, creds, account_id, delete_threshold_hours,
+                                      workers=DELETE_WORKERS, progress=None, mode="stream"):
+    progress = progress or DeleteProgress()
+    queue = asyncio.Queue(maxsize=DELETE_QUEUE_SIZE)
+
+    logging.info(f"Starting deletion of listings older than {delete_threshold_hours} hours with {workers} workers ({mode} mode)")
+
+    async def produce():
+        async for listing in iter_old_listings(session, creds, account_id, delete_threshold_hours, progress, mode):
+            await queue.put(listing["id"])
+
+    async def consume():
+        while True:
+            listing_id = await queue.get()
+            if listing_id is None:
+                return
+            try:
+                await retire_listing(session, creds, listing_id, progress)
+            except Exception as e:
+                progress.failed_draft += 1
+                logging.error(f"Error retiring listing {listing_id}: {str(e)}")
+
+    async def drain():
+        for _ in consumers:
+            await queue.put(None)
+        await asyncio.gather(*consumers, return_exceptions=True)
+
+    consumers = [asyncio.create_task(consume()) for _ in range(workers)]
+    try:
+        await produce()
+    except asyncio.CancelledError:
+        for consumer in consumers:
+            consumer.cancel()
+        await asyncio.gather(*consumers, return_exceptions=True)
+        raise
+    except Exception:
+        # Let the workers finish what was queued before the scan failed
+        await drain()
+        raise
+    await drain()
     
+    return progress.as_dict()
+
+# Function to plan a sweep without changing anything
+async def plan_old_listing_deletion(session, creds, account_id, delete_threshold_hours, workers, mode="stream"):
+    current_time = datetime.now(timezone.utc).timestamp()
+    # Taken before this scan refreshes the snapshot: what a sweep started now would fetch
+    refresh = inventory.refresh_kind(creds[0], account_id)
+    if mode == "snapshot":
+        candidates = await inventory.older_than(session, creds[0], creds[1], account_id,
+                                                current_time - delete_threshold_hours)
+        scanned = len(candidates)
+        histogram = InventoryColumns(candidates).age_histogram(current_time)
+    else:
+        snapshot = await inventory.get(session, creds[0], creds[1], account_id)
+        columns = snapshot.columns()
+        candidates = columns.older_than(current_time, delete_threshold_hours)
+        scanned = len(snapshot)
+        histogram = columns.age_histogram(current_time, candidates)
+
+    # Listing pages the sweep's own scan needs
+    if refresh == "fresh":
+        scan_pages = 0
+    elif mode == "snapshot":
+        # created:asc walk, stopped on the first page reaching past the cutoff
+        scan_pages = len(candidates) // LISTING_PAGE_SIZE + 1
+    elif refresh == "full":
+        scan_pages = max(1, math.ceil(scanned / LISTING_PAGE_SIZE))
+    else:
+        scan_pages = DELTA_SYNC_WINDOW
+
+    # Plus one draft PATCH and one DELETE per listing
+    calls = scan_pages + 2 * len(candidates)
+    governor = get_governor(creds[0])
+    stats = governor.get_stats()
     return {
-        "drafted": drafted_count,
-        "deleted": deleted_count,
-        "failed_draft": failed_draft_count,
-        "failed_delete": failed_delete_count
+        "dry_run": True,
+        "scanned": scanned,
+        "matched": len(candidates),
+        "age_histogram": histogram,
+        "snapshot": refresh,
+        "upstream_calls": {"scan_pages": scan_pages, "draft": len(candidates), "delete": len(candidates),
+                           "total": calls},
+        "rate_per_second": stats["rate_per_second"],
+        "concurrency": min(workers, stats["concurrency_limit"]),
+        "measured_latency": stats["latency"],
+        "projected_seconds": round(governor.projected_seconds(calls, workers), 1)
     }
 
 # API Route to delete old listings
 @router.post("/delete-old-listings")
-async def delete_old_listings(request: Request):
+async def delete_old_listings(request: Request, session: aiohttp.ClientSession = Depends(get_http_session)):
     body = await request.json()
     api_key = body.get("api_key")
     api_secret = body.get("api_secret")
     delete_threshold = float(body.get("delete_threshold", 0))
+    workers = max(1, min(int(body.get("workers", DELETE_WORKERS)), MAX_DELETE_WORKERS))
+    mode = body.get("mode", "stream")
+    if mode not in DELETE_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(DELETE_MODES)}")
 
     if not api_key or not api_secret:
         raise HTTPException(status_code=400, detail="API Key and Secret are required")
 
-    async with aiohttp.ClientSession() as session:
-        headers = get_auth_headers(api_key, api_secret)
-        account_id = await get_my_account_id(session, headers)
+    creds = (api_key, api_secret)
+    account_id = await get_my_account_id(session, creds)
+
+    if not account_id:
+        raise HTTPException(status_code=400, detail="Failed to retrieve account ID")
+
+    logging.info(f"Account ID: {account_id} - Deleting listings older than {delete_threshold} hours")
+    if body.get("dry_run"):
+        try:
+            plan = await plan_old_listing_deletion(session, creds, account_id, delete_threshold, workers, mode=mode)
+        except PageFetchError as e:
+            raise HTTPException(status_code=502, detail=str(e))
+        return {"message": "Dry run, nothing was changed", "mode": mode, "plan": plan}
+
+    if body.get("background"):
+        # Return right away; progress is polled at /delete-jobs/{job_id}
+        params = {"account": tenant_id_for(api_key), "delete_threshold": delete_threshold,
+                  "workers": workers, "mode": mode}
+        job = delete_jobs.start(
+            "delete-old-listings", DeleteProgress(), params,
+            lambda progress: process_old_onsale_listings(session, creds, account_id, delete_threshold,
+                                                         workers, progress=progress, mode=mode)
+        )
+        return {"message": "Deletion job started", "status": "SUCCESS", "job_id": job.job_id}
+
+    try:
+        results = await process_old_onsale_listings(session, creds, account_id, delete_threshold, workers, mode=mode)
+    except PageFetchError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
-        if not account_id:
-            raise HTTPException(status_code=400, detail="Failed to retrieve account ID")
+    return {"message": "Processing completed", "mode": mode, "results": results}
+# API Routes for background deletion jobs
+@router.get("/delete-jobs")
+async def list_delete_jobs():
+    return {"jobs": [job.as_dict() for job in delete_jobs.list()]}
 
-        logging.info(f"Account ID: {account_id} - Deleting listings older than {delete_threshold} hours")
-        results = await process_old_onsale_listings(session, headers, account_id, delete_threshold)
+@router.get("/delete-jobs/{job_id}")
+async def get_delete_job(job_id: str):
+    job = delete_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.as_dict()
 
-    return {"message": "Processing completed", "results": results}
\ No newline at end of file
+@router.post("/delete-jobs/{job_id}/cancel")
+async def cancel_delete_job(job_id: str):
+    job = delete_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return {"message": "Cancellation requested" if not job.done else "Job already finished",
+            "status": "SUCCESS", "job_id": job_id}
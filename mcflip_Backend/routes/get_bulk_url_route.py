@@ -1,102 +1,99 @@
-from fastapi import APIRouter, HTTPException, Header
+from fastapi import APIRouter, HTTPException, Header, Depends
+from fastapi.responses import StreamingResponse
 import aiohttp
-import asyncio
-import pyotp
 import hashlib
+import json
 import os
-from typing import List, Dict
+from typing import Dict, Optional, Tuple
 from pathlib import Path
+from utils.accounts import resolve_account_id
+from utils.fingerprints import KEEP_CHOICES, fingerprint, fingerprints, parse_fields
+from utils.http_client import get_http_session
+from utils.inventory import inventory
+from utils.pagination import PageFetchError
 
 router = APIRouter()
 BASE_URL = os.getenv("BASE_URL")
 
-# Function to generate authentication headers for API requests
-def get_auth_headers(api_key: str, api_secret: str) -> Dict[str, str]:
-    """Generate authentication headers with a fresh TOTP token using user-provided API credentials."""
-    totp = pyotp.TOTP(api_secret)
-    return {
-        "Authorization": f"GFAPI {api_key}:{totp.now()}",
-        "Content-Type": "application/json"
-    }
-
-async def make_request(session: aiohttp.ClientSession, url: str, api_key: str, api_secret: str, params: Dict = None) -> Dict:
-    """Make an API request with error handling and retry logic."""
-    for _ in range(3):  # Max retries
-        headers = get_auth_headers(api_key, api_secret)
-        try:
-            async with session.get(url, params=params, headers=headers) as response:
-                data = await response.json()
-                print(f"ijhugyf", data)
-                if response.status == 200 and data.get('status') != 'FAILURE':
-                    return data
-                elif "Invalid api otp" in data.get("error", {}).get("message", ""):
-                    await asyncio.sleep(1)  # Allow time for a new OTP
-        except Exception as e:
-            print(f"Request error: {e}")
-            await asyncio.sleep(1)
-    return {}
-
 async def get_account_id(session: aiohttp.ClientSession, api_key: str, api_secret: str) -> str:
-    """Fetch the authenticated user's account ID."""
-    url = f"{BASE_URL}/account/me/profile"
-    data = await make_request(session, url, api_key, api_secret)
-    return data.get("data", {}).get("owner", "")
+    """Fetch the authenticated user's account ID (cached per credential)."""
+    return await resolve_account_id(session, api_key, api_secret) or ""
 
-async def get_listings(session: aiohttp.ClientSession, account_id: str, api_key: str, api_secret: str) -> List[Dict]:
-    """Fetch listings from GameFlip."""
-    listings = []
-    start = 0
-    batch_size = 100
+def format_listing_url(listing: Dict) -> str:
+    """Generate the listing's public URL."""
+    return f"https://gameflip.com/item/{listing.get('id', '')}"
 
-    while True:
-        url = f"{BASE_URL}/listing"
-        params = {"owner": account_id, "start": start, "limit": batch_size, "status": "onsale"}
-        data = await make_request(session, url, api_key, api_secret, params)
+async def stream_unique_urls(session: aiohttp.ClientSession, account_id: str, api_key: str, api_secret: str,
+                             fields: Tuple[str, ...]):
+    """NDJSON lines: one {"url": ...} per unique listing as its page arrives, then a summary."""
+    seen = set()
+    scanned = 0
+    try:
+        async for page in inventory.iter_listings(session, api_key, api_secret, account_id):
+            lines = []
+            for listing in page:
+                scanned += 1
+                key = fingerprint(listing, fields)
+                if key in seen:
+                    continue
+                seen.add(key)
+                lines.append(json.dumps({"url": format_listing_url(listing)}))
+            if lines:
+                yield "\n".join(lines) + "\n"
+    except PageFetchError as e:
+        yield json.dumps({"type": "error", "detail": str(e), "count": len(seen), "scanned": scanned}) + "\n"
+        return
+    yield json.dumps({"type": "summary", "count": len(seen), "scanned": scanned,
+                      "duplicates": scanned - len(seen)}) + "\n"
 
-        if not data or 'data' not in data:
-            break
+@router.get("/gameflip/listings")
+async def fetch_listings(
+    apiKey: str = Header(...),
+    apiSecret: str = Header(...),
+    stream: bool = False,
+    fields: Optional[str] = None,
+    keep: str = "newest",
+    session: aiohttp.ClientSession = Depends(get_http_session)
+):
+    """
+    Fetch and return unique GameFlip listings based on combined properties.
+    `fields` (comma-separated) picks the properties compared, FINGERPRINT_FIELDS by default.
+    The response lists the duplicate groups with the listing kept (`keep`: newest or
+    oldest) and the redundant IDs, ready for cleanup.
+    With stream=true the URLs are sent as NDJSON while the inventory is walked (the
+    first listing of each duplicate group is kept), followed by a summary record.
+    """
+    try:
+        fingerprint_fields = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if keep not in KEEP_CHOICES:
+        raise HTTPException(status_code=400, detail=f"keep must be one of {', '.join(KEEP_CHOICES)}")
+    account_id = await get_account_id(session, apiKey, apiSecret)
+    if not account_id:
+        raise HTTPException(status_code=400, detail="Failed to retrieve account ID.")
 
-        listings.extend(data['data'])
-        if len(data['data']) < batch_size:
-            break  # End of listings
+    if stream:
+        return StreamingResponse(stream_unique_urls(session, account_id, apiKey, apiSecret, fingerprint_fields),
+                                 media_type="application/x-ndjson")
 
-        start += batch_size
-        await asyncio.sleep(0.1)
-    
-    return listings
+    try:
+        snapshot = await inventory.get(session, apiKey, apiSecret, account_id)
+    except PageFetchError as e:
+        raise HTTPException(status_code=502, detail=str(e))
 
-def format_listing_url(listing: Dict) -> str:
-    """Generate the listing's public URL."""
-    return f"https://gameflip.com/item/{listing.get('id', '')}"
+    # Only listings that are new or changed since the last run are hashed
+    index = fingerprints.index(apiKey, fingerprint_fields)
+    index.sync(snapshot.values())
+    duplicate_groups = index.duplicate_groups(keep=keep)
+    redundant = {listing_id for group in duplicate_groups for listing_id in group["redundant"]}
 
-@router.get("/gameflip/listings")
-async def fetch_listings(apiKey: str = Header(...), apiSecret: str = Header(...)):
-    """Fetch and return unique GameFlip listings based on combined properties."""
-    async with aiohttp.ClientSession() as session:
-        account_id = await get_account_id(session, apiKey, apiSecret)
-        if not account_id:
-            raise HTTPException(status_code=400, detail="Failed to retrieve account ID.")
+    unique_urls = [format_listing_url(listing) for listing in snapshot.values() if listing["id"] not in redundant]
 
-        listings = await get_listings(session, account_id, apiKey, apiSecret)
-        
-        # Dictionary to track unique listings
-        unique_listings = {}
-        
-        for listing in listings:
-            # Create a combined key for uniqueness check
-            combined = (
-                f"{listing.get('name', '').strip().lower()}"
-                f"{str(listing.get('price', 0))}"
-                f"{listing.get('description', '').strip().lower()}"
-                f"{listing.get('platform', '').strip().lower()}"
-                f"{listing.get('category', '').strip().lower()}"
-                f"{str(listing.get('tags', []))}"
-            )
-            
-            # Store the listing URL using the combined key
-            unique_listings[combined] = format_listing_url(listing)
-        
-        # Get the unique URLs
-        unique_urls = list(unique_listings.values())
-    
-    return {"count": len(unique_urls), "urls": unique_urls}
+    return {
+        "count": len(unique_urls),
+        "urls": unique_urls,
+        "fields": list(fingerprint_fields),
+        "duplicate_groups": duplicate_groups,
+        "redundant_count": len(redundant)
+    }
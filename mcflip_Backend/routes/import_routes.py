@@ -3,12 +3,11 @@ from pydantic import BaseModel
 import aiohttp
 import asyncio
 import json
-import pyotp
-import base64
 import os
 import re
 from datetime import datetime
-from utils.auth import get_auth_headers 
+from utils.http_client import get_http_session
+from utils.upstream import upstream_request
 
 # Create an API router for handling import-related endpoints
 router = APIRouter()
@@ -18,58 +17,36 @@ BASE_URL = os.getenv("BASE_URL")
 # API_KEY = os.getenv("API_KEY")
 # API_SECRET = os.getenv("API_SECRET")
 
+# URLs imported at once (overridable with "concurrency" on the request); the photos
+# of each listing are downloaded in parallel on top of that
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "8"))
+MAX_IMPORT_CONCURRENCY = 32
+
 # Define a Pydantic model to validate incoming request data
 class URLList(BaseModel):
     urls: list[str]
 
-# Function to generate authentication headers for API requests
-def get_auth_headers(api_key: str, api_secret: str, content_type="application/json"):
-    try:
-        base64.b32decode(api_secret)  # Validate API_SECRET format
-    except:
-        api_secret = base64.b32encode(api_secret.encode()).decode()
-
-    totp = pyotp.TOTP(api_secret)  # Generate one-time password (OTP)
-    otp = totp.now()
-
-    headers = {
-        "Authorization": f"GFAPI {api_key}:{otp}",
-        "Content-Type": content_type
-    }
-    return headers
-
-# Function to make API requests with retry logic
-async def api_request(session, method, endpoint, api_key, api_secret, data=None, params=None, retries=3):
-    url = BASE_URL + endpoint
+# Function to make API requests through the shared upstream client
+async def api_request(session, method, endpoint, api_key, api_secret, data=None, params=None):
     content_type = "application/json-patch+json" if method.upper() == 'PATCH' else "application/json"
-
-    for attempt in range(retries):
-        headers = get_auth_headers(api_key, api_secret, content_type)
-        try:
-            async with getattr(session, method.lower())(url, headers=headers, json=data, params=params) as response:
-                response_data = await response.json()
-                if response.status == 200:
-                    return response_data
-                elif response_data.get('error', {}).get('message') == 'Invalid api otp':
-                    print("Invalid OTP. Retrying...")
-                    await asyncio.sleep(1)
-                    continue
-                else:
-                    print(f"Error: {response_data}")
-                    return None
-        except Exception as e:
-            print(f"Error: {str(e)}")
-            await asyncio.sleep(1)
+    result = await upstream_request(session, method, endpoint, (api_key, api_secret), content_type,
+                                    json=data, params=params)
+    if result.ok:
+        return result.data
+    print(f"Error ({result.error}): {result.data}")
     return None
 
 
+def write_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(data)
+
 # Function to download an image from a URL and save it locally
 async def download_image(session, url, filename):
     try:
         async with session.get(url) as response:
             if response.status == 200:
-                with open(filename, 'wb') as f:
-                    f.write(await response.read())
+                await asyncio.to_thread(write_file, filename, await response.read())
                 return True
             else:
                 print(f"Failed to download image: HTTP {response.status}")
@@ -95,12 +72,15 @@ async def process_url(session, url, batch_dir, api_key, api_secret):
                 images_dir = os.path.join(batch_dir, 'images')
                 os.makedirs(images_dir, exist_ok=True)
 
-                for photo_id, photo_data in listing_info['photo'].items():
-                    if 'view_url' in photo_data:
-                        image_filename = os.path.join(images_dir, f"{listing_id}_{photo_id}.jpg")
-                        if await download_image(session, photo_data['view_url'], image_filename):
-                            print(f"Downloaded image to {image_filename}")
-                            image_urls.append(os.path.relpath(image_filename, "."))
+                # Download every photo at once, keeping the listing's photo order
+                photos = [(os.path.join(images_dir, f"{listing_id}_{photo_id}.jpg"), photo_data['view_url'])
+                          for photo_id, photo_data in listing_info['photo'].items() if 'view_url' in photo_data]
+                downloaded = await asyncio.gather(*(download_image(session, view_url, image_filename)
+                                                    for image_filename, view_url in photos))
+                for (image_filename, _), ok in zip(photos, downloaded):
+                    if ok:
+                        print(f"Downloaded image to {image_filename}")
+                        image_urls.append(os.path.relpath(image_filename, "."))
 
             listing_info['image_urls'] = image_urls
             return listing_info
@@ -113,7 +93,7 @@ async def process_url(session, url, batch_dir, api_key, api_secret):
 
 # API endpoint to import multiple listings from provided URLs
 @router.post("/import-listings")
-async def import_listings(request: Request, data: URLList):
+async def import_listings(request: Request, data: URLList, session: aiohttp.ClientSession = Depends(get_http_session)):
     body = await request.json()
     api_key = body.get("api_key")
     api_secret = body.get("api_secret")
@@ -125,22 +105,36 @@ async def import_listings(request: Request, data: URLList):
     if not urls:
         raise HTTPException(status_code=400, detail="No URLs provided")
 
-    async with aiohttp.ClientSession() as session:
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        batch_dir = f'gameflip_data_{timestamp}'
-        os.makedirs(batch_dir, exist_ok=True)
-
-        listings = []
-        for url in urls:
-            listing_data = await process_url(session, url, batch_dir, api_key, api_secret)
-            if listing_data:
-                listings.append(listing_data)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    batch_dir = f'gameflip_data_{timestamp}'
+    os.makedirs(batch_dir, exist_ok=True)
+
+    concurrency = max(1, min(int(body.get("concurrency", IMPORT_CONCURRENCY)), MAX_IMPORT_CONCURRENCY))
+    slots = asyncio.Semaphore(concurrency)
+
+    async def import_one(url):
+        async with slots:
+            return await process_url(session, url, batch_dir, api_key, api_secret)
+
+    # Results come back in URL order; a failed URL yields None and the rest carry on
+    results = await asyncio.gather(*(import_one(url) for url in urls), return_exceptions=True)
+    listings = []
+    failed = []
+    for url, listing_data in zip(urls, results):
+        if isinstance(listing_data, Exception):
+            print(f"Error processing {url}: {str(listing_data)}")
+            listing_data = None
+        if listing_data:
+            listings.append(listing_data)
+        else:
+            failed.append(url)
 
     json_filename = os.path.join(batch_dir, 'listings.json')
     with open(json_filename, 'w', encoding='utf-8') as f:
         json.dump(listings, f, indent=2, ensure_ascii=False)
 
-    return {"message": "Import completed", "count": len(listings), "data": listings, "json_file": json_filename}
+    return {"message": "Import completed", "count": len(listings), "data": listings, "json_file": json_filename,
+            "failed": failed}
 
 
 # Function to extract listing ID from a given URL using regex patterns
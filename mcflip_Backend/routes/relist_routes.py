@@ -0,0 +1,189 @@
+from fastapi import APIRouter, HTTPException, Depends, Request
+import aiohttp
+import asyncio
+import itertools
+import logging
+import os
+from utils.http_client import get_http_session
+from utils.image_cache import image_cache
+from utils.pagination import PageFetchError
+from utils.auth import tenant_id_for
+from utils.posting_scheduler import ListingState
+from utils.queued_listing import QueuedListing
+from routes.delete_listings_routes import (
+    DELETE_MODES, DELETE_QUEUE_SIZE, DELETE_WORKERS, MAX_DELETE_WORKERS,
+    DeleteProgress, delete_jobs, get_my_account_id, iter_old_listings, retire_listing
+)
+from routes.post_routes import ListingRequest, post_single_listing, scheduler
+
+router = APIRouter()
+
+# Rolling relist: one job replaces expired listings with fresh posts.
+#
+# The inventory scan first collects the expired listings, then feeds each one into
+# two lanes at once: the delete lane drafts and deletes it, the repost lane posts the
+# next listing template through the regular posting path (photos come from the image
+# cache, warmed before the lanes start). Each lane may run at most `max_lead` listings
+# ahead of the other, so the onsale count stays within that margin of where it
+# started, and the job takes about as long as the slower lane. Jobs share the deletion
+# job registry and are polled at /delete-jobs/{job_id}.
+
+RELIST_MAX_LEAD = int(os.getenv("RELIST_MAX_LEAD", "4"))
+
+# Live counters of a relist: the deletion counters plus the repost lane
+class RelistProgress(DeleteProgress):
+    def __init__(self):
+        super().__init__()
+        self.posted = 0
+        self.failed_post = 0
+
+    def as_dict(self):
+        return {
+            **super().as_dict(),
+            "posted": self.posted,
+            "failed_post": self.failed_post,
+            "onsale_delta": self.posted - self.drafted
+        }
+
+# Function to fetch every template photo once so the reposts are served from the cache
+async def warm_photos(session, templates):
+    urls = {url for t in templates for url in (t.image_url, *t.additional_images) if url}
+    await asyncio.gather(*(image_cache.fetch(session, url) for url in urls))
+    return len(urls)
+
+# Function to relist old listings
+async def relist_old_listings(session, creds, account_id, delete_threshold, templates,
+                              workers=DELETE_WORKERS, progress=None, mode="stream", max_lead=RELIST_MAX_LEAD):
+    progress = progress or RelistProgress()
+    state = ListingState(f"relist:{tenant_id_for(creds[0])}")
+    delete_queue = asyncio.Queue(maxsize=DELETE_QUEUE_SIZE)
+    repost_queue = asyncio.Queue(maxsize=DELETE_QUEUE_SIZE)
+    # A finished repost lets one more delete start and vice versa
+    delete_credits = asyncio.Semaphore(max_lead)
+    repost_credits = asyncio.Semaphore(max_lead)
+    next_template = itertools.cycle(templates)
+
+    logging.info(f"Starting relist of listings older than {delete_threshold} hours with "
+                 f"{workers} workers per lane and {len(templates)} templates ({mode} mode)")
+    await warm_photos(session, templates)
+    # Every candidate is known before the first repost or delete, so the lanes never
+    # shift the offsets of a search that is still being walked
+    candidates = [listing["id"] async for listing in
+                  iter_old_listings(session, creds, account_id, delete_threshold, progress, mode)]
+
+    async def produce():
+        for listing_id in candidates:
+            await delete_queue.put(listing_id)
+            await repost_queue.put(next(next_template))
+
+    async def delete_lane():
+        while True:
+            listing_id = await delete_queue.get()
+            if listing_id is None:
+                return
+            await delete_credits.acquire()
+            try:
+                await retire_listing(session, creds, listing_id, progress)
+            except Exception as e:
+                progress.failed_draft += 1
+                logging.error(f"Error retiring listing {listing_id}: {str(e)}")
+            finally:
+                repost_credits.release()
+
+    async def repost_lane():
+        while True:
+            template = await repost_queue.get()
+            if template is None:
+                return
+            await repost_credits.acquire()
+            try:
+                if await post_single_listing(session, template, creds[0], creds[1], state):
+                    progress.posted += 1
+                else:
+                    progress.failed_post += 1
+            except Exception as e:
+                progress.failed_post += 1
+                logging.error(f"Error reposting {template}: {str(e)}")
+            finally:
+                delete_credits.release()
+
+    async def drain():
+        for _ in range(workers):
+            await delete_queue.put(None)
+            await repost_queue.put(None)
+        await asyncio.gather(*lanes, return_exceptions=True)
+
+    lanes = [asyncio.create_task(lane()) for lane in (delete_lane, repost_lane) for _ in range(workers)]
+    try:
+        await produce()
+    except asyncio.CancelledError:
+        for lane in lanes:
+            lane.cancel()
+        await asyncio.gather(*lanes, return_exceptions=True)
+        raise
+    await drain()
+
+    return progress.as_dict()
+
+# Function to pick the listings to repost: the request's own, else the account's posting batch
+def relist_templates(body, api_key):
+    if body.get("listings"):
+        try:
+            return [QueuedListing.from_fields(ListingRequest(**fields).dict()) for fields in body["listings"]]
+        except Exception as exc:
+            raise HTTPException(status_code=422, detail=f"Invalid listing data: {str(exc)}")
+    tenant = scheduler.tenants.get(tenant_id_for(api_key))
+    return list(tenant.batch) if tenant is not None else []
+
+# API Route to relist old listings
+@router.post("/relist-old-listings")
+async def relist_old_listings_route(request: Request, session: aiohttp.ClientSession = Depends(get_http_session)):
+    """
+    Delete listings older than delete_threshold and post a replacement for each one,
+    overlapping both. Replacements cycle through `listings` (same fields as
+    /post-listing-with-image) or, without it, the account's current posting batch.
+    """
+    body = await request.json()
+    api_key = body.get("api_key")
+    api_secret = body.get("api_secret")
+    delete_threshold = float(body.get("delete_threshold", 0))
+    workers = max(1, min(int(body.get("workers", DELETE_WORKERS)), MAX_DELETE_WORKERS))
+    max_lead = max(1, int(body.get("max_lead", RELIST_MAX_LEAD)))
+    mode = body.get("mode", "stream")
+    if mode not in DELETE_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {', '.join(DELETE_MODES)}")
+
+    if not api_key or not api_secret:
+        raise HTTPException(status_code=400, detail="API Key and Secret are required")
+    if delete_threshold <= 0:
+        # Otherwise the fresh reposts would count as expired themselves
+        raise HTTPException(status_code=400, detail="delete_threshold must be greater than 0")
+
+    templates = relist_templates(body, api_key)
+    if not templates:
+        raise HTTPException(status_code=400, detail="No listings to repost: send listings or start a posting batch first")
+
+    creds = (api_key, api_secret)
+    account_id = await get_my_account_id(session, creds)
+    if not account_id:
+        raise HTTPException(status_code=400, detail="Failed to retrieve account ID")
+
+    logging.info(f"Account ID: {account_id} - Relisting listings older than {delete_threshold} hours")
+    if body.get("background"):
+        # Return right away; progress is polled at /delete-jobs/{job_id}
+        params = {"account": tenant_id_for(api_key), "delete_threshold": delete_threshold, "workers": workers,
+                  "mode": mode, "max_lead": max_lead, "templates": len(templates)}
+        job = delete_jobs.start(
+            "relist-old-listings", RelistProgress(), params,
+            lambda progress: relist_old_listings(session, creds, account_id, delete_threshold, templates,
+                                                 workers, progress=progress, mode=mode, max_lead=max_lead)
+        )
+        return {"message": "Relist job started", "status": "SUCCESS", "job_id": job.job_id}
+
+    try:
+        results = await relist_old_listings(session, creds, account_id, delete_threshold, templates,
+                                            workers, mode=mode, max_lead=max_lead)
+    except PageFetchError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
+    return {"message": "Relist completed", "mode": mode, "results": results}
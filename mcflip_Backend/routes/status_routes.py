@@ -0,0 +1,22 @@
+from fastapi import APIRouter
+from utils.accounts import get_account_stats
+from utils.auth import get_auth_stats
+from utils.http_client import get_pool_stats
+from utils.inventory import inventory
+from utils.rate_governor import get_governor_stats
+from utils.upstream import get_breaker_stats
+
+router = APIRouter()
+
+# Monitoring endpoint for the shared upstream client
+@router.get("/upstream-status")
+async def upstream_status():
+    """Report the state of the shared upstream connection pool, OTP generator, rate governors, circuit breakers, inventory and account caches."""
+    return {
+        "http_pool": get_pool_stats(),
+        "auth": get_auth_stats(),
+        "governors": get_governor_stats(),
+        "circuit_breakers": get_breaker_stats(),
+        "inventory": inventory.get_stats(),
+        "accounts": get_account_stats(),
+    }
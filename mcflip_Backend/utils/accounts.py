@@ -0,0 +1,74 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+from utils.auth import tenant_id_for
+from utils.upstream import upstream_request
+
+# API key -> owner (account) ID cache.
+#
+# Every inventory and cleanup request needs the owner ID of its credentials. It is
+# looked up once via /account/me/profile and kept for ACCOUNT_ID_TTL seconds.
+# Credentials the upstream rejects (401/403, or OTP codes refused on every retry) are
+# remembered for ACCOUNT_NEGATIVE_TTL seconds so a misconfigured client does not
+# hammer the profile endpoint; transient failures are not cached. Concurrent lookups
+# for the same credentials share one request.
+
+ACCOUNT_ID_TTL = float(os.getenv("ACCOUNT_ID_TTL", "3600"))
+ACCOUNT_NEGATIVE_TTL = float(os.getenv("ACCOUNT_NEGATIVE_TTL", "60"))
+PROFILE_ENDPOINT = "/account/me/profile"
+
+_accounts: Dict[str, Tuple[float, Optional[str]]] = {}   # credential -> (expires, owner ID or None)
+_in_flight: Dict[str, asyncio.Future] = {}
+_stats = {"hits": 0, "negative_hits": 0, "lookups": 0, "coalesced": 0}
+
+
+def _credential(api_key: str, api_secret: str) -> str:
+    # Keyed on the secret as well, so a wrong secret cannot poison the right one
+    return tenant_id_for(f"{api_key}:{api_secret}")
+
+
+async def _lookup(session, api_key: str, api_secret: str, credential: str) -> Optional[str]:
+    _stats["lookups"] += 1
+    result = await upstream_request(session, "GET", PROFILE_ENDPOINT, (api_key, api_secret))
+    owner = None
+    if result.ok and isinstance(result.data, dict):
+        owner = (result.data.get("data") or {}).get("owner")
+    if owner:
+        _accounts[credential] = (time.monotonic() + ACCOUNT_ID_TTL, owner)
+    elif (result.error == "http" and result.status in (401, 403)) or result.error == "otp":
+        # A wrong secret signs wrong codes, so OTP rejections on every retry mean the same
+        logging.warning(f"Credentials rejected by the profile endpoint ({result.error} {result.status}): {result.message}")
+        _accounts[credential] = (time.monotonic() + ACCOUNT_NEGATIVE_TTL, None)
+    else:
+        logging.error(f"Account ID lookup failed ({result.error}): {result.data}")
+    return owner
+
+
+async def resolve_account_id(session, api_key: str, api_secret: str) -> Optional[str]:
+    """The owner ID of the credentials, or None if it could not be resolved."""
+    credential = _credential(api_key, api_secret)
+    cached = _accounts.get(credential)
+    if cached is not None and cached[0] > time.monotonic():
+        _stats["hits" if cached[1] else "negative_hits"] += 1
+        return cached[1]
+
+    pending = _in_flight.get(credential)
+    if pending is not None:
+        _stats["coalesced"] += 1
+        return await asyncio.shield(pending)
+
+    future = asyncio.ensure_future(_lookup(session, api_key, api_secret, credential))
+    _in_flight[credential] = future
+    try:
+        return await asyncio.shield(future)
+    finally:
+        if future.done():
+            _in_flight.pop(credential, None)
+        else:
+            future.add_done_callback(lambda _: _in_flight.pop(credential, None))
+
+
+def get_account_stats() -> Dict[str, int]:
+    return {**_stats, "cached": len(_accounts)}
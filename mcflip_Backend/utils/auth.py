@@ -1,6 +1,11 @@
 import os
-import pyotp
+import time
 import base64
+import hashlib
+import logging
+import pyotp
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Set, Tuple
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -8,23 +13,138 @@ load_dotenv()
 API_KEY = os.getenv('API_KEY')
 API_SECRET = os.getenv('API_SECRET')
 
-# Function to generate authentication headers
-def get_auth_headers(content_type="application/json"):
-    """
-    Generates API authentication headers including the OTP.
-    """
+# TOTP authentication shared by every route.
+#
+# The decoded secret and the OTP of the current 30 s window are cached per credential,
+# so generating headers is a dict lookup. Time is corrected for clock skew against the
+# upstream `Date` header, and close to a window boundary the next window's code is used
+# so a request signed at 29.9 s does not arrive with an expired OTP. A rejected code's
+# window is remembered, and retries walk the neighbouring windows nearest in time,
+# alternating sides and skipping every window already rejected.
+
+OTP_INTERVAL = 30
+OTP_LEAD_SECONDS = float(os.getenv("OTP_LEAD_SECONDS", "1"))  # switch to the next code this early
+SKEW_SMOOTHING = 0.2                                            # EWMA weight of a new Date sample
+
+_totps: Dict[Tuple[str, str], pyotp.TOTP] = {}
+_otp_cache: Dict[Tuple[str, str], Tuple[int, str]] = {}  # credential -> (window, otp)
+_rejected: Dict[Tuple[str, str], Set[int]] = {}         # credential -> windows whose code was rejected
+_clock_offset = 0.0      # upstream time minus local time, seconds
+_skew_samples = 0
+_stats = {"generated": 0, "cached": 0, "rejections": 0}
+
+
+def tenant_id_for(api_key: str) -> str:
+    """Stable, non-secret identifier for a credential."""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+def normalize_secret(api_secret: str) -> str:
+    """Return a valid base32 secret, encoding raw secrets the way the API expects."""
     try:
-        # Validate API_SECRET format
-        base64.b32decode(API_SECRET)
-        secret = API_SECRET
-    except:
-        secret = base64.b32encode(API_SECRET.encode()).decode()
+        # Validate API_SECRET format (pyotp accepts unpadded secrets)
+        base64.b32decode(api_secret + "=" * (-len(api_secret) % 8), casefold=True)
+        return api_secret
+    except Exception:
+        return base64.b32encode(api_secret.encode()).decode()
+
+
+def _totp(api_key: str, api_secret: str) -> pyotp.TOTP:
+    credential = (api_key, api_secret)
+    totp = _totps.get(credential)
+    if totp is None:
+        totp = pyotp.TOTP(normalize_secret(api_secret), interval=OTP_INTERVAL)
+        _totps[credential] = totp
+    return totp
+
+
+def upstream_time() -> float:
+    return time.time() + _clock_offset
+
+
+def _candidates(now: float) -> List[int]:
+    """Windows around `now`, nearest first (with the lead applied), alternating sides."""
+    reference = now + OTP_LEAD_SECONDS
+    primary = int(reference // OTP_INTERVAL)
+    nearer = 1 if reference - primary * OTP_INTERVAL >= OTP_INTERVAL / 2 else -1
+    return [primary, primary + nearer, primary - nearer, primary + 2 * nearer, primary - 2 * nearer]
 
-    # Generate OTP
-    totp = pyotp.TOTP(secret)
-    otp = totp.now()
 
+def _window(credential: Tuple[str, str], now: float, attempt: int) -> int:
+    candidates = _candidates(now)
+    if attempt == 0:
+        return candidates[0]
+    rejected = _rejected.get(credential, ())
+    for window in candidates:
+        if window not in rejected:
+            return window
+    return candidates[attempt % len(candidates)]
+
+
+def get_otp(api_key: str, api_secret: str, attempt: int = 0) -> str:
+    credential = (api_key, api_secret)
+    window = _window(credential, upstream_time(), attempt)
+    cached = _otp_cache.get(credential)
+    if cached is not None and cached[0] == window:
+        _stats["cached"] += 1
+        return cached[1]
+    otp = _totp(api_key, api_secret).generate_otp(window)
+    _stats["generated"] += 1
+    if attempt == 0:
+        _otp_cache[credential] = (window, otp)
+    return otp
+
+
+def get_auth_headers(api_key: Optional[str] = None, api_secret: Optional[str] = None,
+                     content_type: str = "application/json", attempt: int = 0) -> Dict[str, str]:
+    """
+    Generates API authentication headers including the OTP. Defaults to the API_KEY /
+    API_SECRET from the environment; `attempt` > 0 picks the code for retrying a rejection.
+    """
+    api_key = api_key or API_KEY
+    api_secret = api_secret or API_SECRET
     return {
-        "Authorization": f"GFAPI {API_KEY}:{otp}",
+        "Authorization": f"GFAPI {api_key}:{get_otp(api_key, api_secret, attempt)}",
         "Content-Type": content_type
     }
+
+
+def observe_server_time(headers) -> None:
+    """Fold the upstream `Date` header of a response into the clock offset estimate."""
+    global _clock_offset, _skew_samples
+    date_value = headers.get("Date") if headers else None
+    if not date_value:
+        return
+    try:
+        # Date has one-second resolution and is truncated, so aim for the middle
+        sample = parsedate_to_datetime(date_value).timestamp() + 0.5 - time.time()
+    except (TypeError, ValueError):
+        return
+    if _skew_samples == 0:
+        _clock_offset = sample
+    else:
+        _clock_offset += SKEW_SMOOTHING * (sample - _clock_offset)
+    _skew_samples += 1
+
+
+def otp_rejected(api_key: Optional[str] = None, api_secret: Optional[str] = None,
+                 otp: Optional[str] = None) -> None:
+    """Forget the cached code for a credential after the upstream rejected `otp`."""
+    _stats["rejections"] += 1
+    credential = (api_key or API_KEY, api_secret or API_SECRET)
+    _otp_cache.pop(credential, None)
+    if otp:
+        totp = _totp(*credential)
+        current = int(upstream_time() // OTP_INTERVAL)
+        rejected = {w for w in _rejected.get(credential, ()) if w >= current - 2}
+        rejected.update(w for w in range(current - 2, current + 3) if totp.generate_otp(w) == otp)
+        _rejected[credential] = rejected
+    logging.warning(f"Invalid OTP rejected upstream (clock offset {_clock_offset:+.2f}s)")
+
+
+def is_otp_error(response_data) -> bool:
+    return "Invalid api otp" in str(response_data)
+
+
+def get_auth_stats() -> Dict[str, float]:
+    return {**_stats, "clock_offset": round(_clock_offset, 3), "skew_samples": _skew_samples}
@@ -0,0 +1,137 @@
+import os
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from utils.auth import tenant_id_for
+from utils.inventory import SNAPSHOT_FIELDS
+
+# Duplicate detection for listings.
+#
+# A listing's fingerprint is a 16-byte BLAKE2b digest over a configurable set of
+# normalized fields, so the uniqueness check does not keep long description strings
+# around. Each account keeps an in-memory index of listing ID -> fingerprint that
+# survives between requests; a rerun only hashes listings that are new or were updated
+# since the last run, and the index also remembers which listings share a fingerprint.
+# Only fields the inventory snapshot keeps can be compared, and at most
+# FINGERPRINT_MAX_INDEXES indexes are held, least recently used dropped first. Indexes
+# are not persisted: after a restart or an eviction the next run hashes the whole
+# inventory again, which only costs time since the fingerprints are recomputed exactly.
+
+FINGERPRINT_FIELDS = tuple(
+    f.strip() for f in os.getenv("FINGERPRINT_FIELDS", "name,price,description,platform,category,tags").split(",")
+    if f.strip()
+)
+FINGERPRINT_SIZE = 16
+KEEP_CHOICES = ("newest", "oldest")
+FINGERPRINT_MAX_INDEXES = int(os.getenv("FINGERPRINT_MAX_INDEXES", "64"))
+
+
+def _normalize(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value.strip().lower()
+    if isinstance(value, (list, tuple)):
+        return "\x1e".join(_normalize(v) for v in value)
+    return str(value)
+
+
+def fingerprint(listing: Dict[str, Any], fields: Tuple[str, ...] = FINGERPRINT_FIELDS) -> bytes:
+    digest = hashlib.blake2b(digest_size=FINGERPRINT_SIZE)
+    for field in fields:
+        digest.update(_normalize(listing.get(field)).encode())
+        digest.update(b"\x1f")
+    return digest.digest()
+
+
+def parse_fields(fields: Optional[str]) -> Tuple[str, ...]:
+    """
+    Fields from a comma-separated query value, or the configured default. Raises
+    ValueError for a field the snapshot does not keep, which would hash as "" everywhere.
+    """
+    if not fields:
+        return FINGERPRINT_FIELDS
+    parsed = tuple(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    if not parsed:
+        return FINGERPRINT_FIELDS
+    unknown = [f for f in parsed if f not in SNAPSHOT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(SNAPSHOT_FIELDS)}")
+    return parsed
+
+
+class FingerprintIndex:
+    def __init__(self, fields: Tuple[str, ...]):
+        self.fields = fields
+        # listing ID -> (updated, created_ts, fingerprint)
+        self._entries: Dict[str, Tuple[Any, float, bytes]] = {}
+        self.hashed = 0
+
+    def sync(self, listings: Iterable[Dict[str, Any]]) -> int:
+        """Bring the index in line with `listings`; returns how many had to be hashed."""
+        hashed = 0
+        current = set()
+        for listing in listings:
+            listing_id = listing.get("id")
+            if not listing_id:
+                continue
+            current.add(listing_id)
+            entry = self._entries.get(listing_id)
+            if entry is not None and entry[0] == listing.get("updated"):
+                continue
+            self._entries[listing_id] = (listing.get("updated"), listing.get("created_ts") or 0.0,
+                                         fingerprint(listing, self.fields))
+            hashed += 1
+        for listing_id in list(self._entries):
+            if listing_id not in current:
+                del self._entries[listing_id]
+        self.hashed += hashed
+        return hashed
+
+    def groups(self) -> Dict[bytes, List[str]]:
+        """Listing IDs per fingerprint, newest listing first."""
+        by_print: Dict[bytes, List[Tuple[float, str]]] = {}
+        for listing_id, (_, created_ts, digest) in self._entries.items():
+            by_print.setdefault(digest, []).append((created_ts, listing_id))
+        return {digest: [listing_id for _, listing_id in sorted(members, reverse=True)]
+                for digest, members in by_print.items()}
+
+    def duplicate_groups(self, keep: str = "newest") -> List[Dict[str, Any]]:
+        """Every fingerprint shared by several listings, as keeper plus redundant IDs."""
+        if keep not in KEEP_CHOICES:
+            raise ValueError(f"keep must be one of {', '.join(KEEP_CHOICES)}")
+        result = []
+        for digest, ids in self.groups().items():
+            if len(ids) < 2:
+                continue
+            if keep == "oldest":
+                ids = ids[::-1]
+            result.append({"fingerprint": digest.hex(), "keeper": ids[0], "redundant": ids[1:]})
+        return result
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class FingerprintStore:
+    """Per-account indexes, kept in memory only and bounded by an LRU of max_indexes."""
+
+    def __init__(self, max_indexes: int = FINGERPRINT_MAX_INDEXES):
+        self.max_indexes = max_indexes
+        self._indexes: "OrderedDict[Tuple[str, Tuple[str, ...]], FingerprintIndex]" = OrderedDict()
+
+    def index(self, api_key: str, fields: Tuple[str, ...] = FINGERPRINT_FIELDS) -> FingerprintIndex:
+        key = (tenant_id_for(api_key), fields)
+        index = self._indexes.get(key)
+        if index is None:
+            index = FingerprintIndex(fields)
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        else:
+            self._indexes.move_to_end(key)
+        return index
+
+
+# Shared instance used by the listing routes
+fingerprints = FingerprintStore()
@@ -0,0 +1,107 @@
+import os
+import logging
+import aiohttp
+from typing import Optional, Dict, Any
+
+# Shared upstream HTTP client.
+#
+# One aiohttp session (and therefore one connection pool) is opened for the
+# lifetime of the app in main.py and handed to every router, so requests to
+# Gameflip reuse kept-alive TCP/TLS connections instead of handshaking each time.
+
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))                  # Total open connections
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "20"))  # Open connections per host
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))    # Seconds an idle connection is kept
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))             # Seconds a DNS answer is reused
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "120"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _build_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=HTTP_TOTAL_TIMEOUT,
+        connect=HTTP_CONNECT_TIMEOUT,
+        sock_read=HTTP_READ_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def start_http_client() -> aiohttp.ClientSession:
+    """Open the shared session. Called once from the app lifespan."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _build_session()
+        logging.info(
+            f"HTTP pool started (limit={HTTP_POOL_LIMIT}, per_host={HTTP_POOL_LIMIT_PER_HOST}, "
+            f"keepalive={HTTP_KEEPALIVE_TIMEOUT}s, dns_ttl={HTTP_DNS_CACHE_TTL}s)"
+        )
+    return _session
+
+
+async def close_http_client():
+    """Close the shared session and every pooled connection."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logging.info("HTTP pool closed")
+    _session = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Return the shared session. Usable as a FastAPI dependency or called directly
+    from background tasks. Falls back to opening the pool lazily when the app
+    was started without the lifespan (e.g. a script importing a router).
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = _build_session()
+    return _session
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Open / idle / acquired connection counts for the shared pool."""
+    if _session is None or _session.closed:
+        return {"running": False}
+
+    connector = _session.connector
+    # aiohttp keeps idle connections in `_conns` (key -> pooled protocols) and
+    # in-use ones in `_acquired`; neither is public, so read them defensively.
+    idle_by_host = {
+        f"{key.host}:{key.port}": len(conns)
+        for key, conns in getattr(connector, "_conns", {}).items()
+    }
+    acquired_by_host = {
+        f"{key.host}:{key.port}": len(conns)
+        for key, conns in getattr(connector, "_acquired_per_host", {}).items()
+    }
+    idle = sum(idle_by_host.values())
+    acquired = len(getattr(connector, "_acquired", ()))
+
+    return {
+        "running": True,
+        "open": idle + acquired,
+        "idle": idle,
+        "acquired": acquired,
+        "limit": connector.limit,
+        "limit_per_host": connector.limit_per_host,
+        "idle_by_host": idle_by_host,
+        "acquired_by_host": acquired_by_host,
+        "keepalive_timeout": HTTP_KEEPALIVE_TIMEOUT,
+        "dns_cache_ttl": HTTP_DNS_CACHE_TTL,
+        "timeouts": {
+            "total": HTTP_TOTAL_TIMEOUT,
+            "connect": HTTP_CONNECT_TIMEOUT,
+            "read": HTTP_READ_TIMEOUT,
+        },
+    }
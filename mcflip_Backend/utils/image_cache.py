@@ -0,0 +1,294 @@
+import os
+import uuid
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Any
+
+# Two-tier image byte cache for reposting.
+#
+# Image URLs map to the SHA-256 of their content; the bytes live once per hash in a
+# byte-bounded in-memory LRU and in an on-disk tier with its own size limit. The
+# global batch reposts the same templates forever, so after the first cycle every
+# photo is served from here instead of being downloaded again.
+
+IMAGE_CACHE_MEMORY_BYTES = int(float(os.getenv("IMAGE_CACHE_MEMORY_MB", "64")) * 1024 * 1024)
+IMAGE_CACHE_DISK_BYTES = int(float(os.getenv("IMAGE_CACHE_DISK_MB", "512")) * 1024 * 1024)
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", ".cache/images")
+
+
+def _url_key(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+class ImageCache:
+    def __init__(self, memory_limit: int, disk_limit: int, disk_dir: str):
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.disk_dir = disk_dir
+        self._urls: Dict[str, str] = {}                          # url -> content hash
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()  # content hash -> bytes, LRU order
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()     # content hash -> size, LRU order
+        self._disk_bytes = 0
+        self._disk_loaded = False
+        self._disk_lock = asyncio.Lock()
+        self._downloads: Dict[str, asyncio.Future] = {}          # url -> in-flight download
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "bytes_downloaded": 0,
+            "bytes_served_from_cache": 0,
+        }
+
+    # ---- disk tier ----
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.disk_dir, "blobs", digest[:2], digest)
+
+    def _url_path(self, url: str) -> str:
+        return os.path.join(self.disk_dir, "urls", _url_key(url))
+
+    def _scan_disk(self) -> list:
+        """(mtime, digest, size) for every blob already on disk."""
+        entries = []
+        blobs_dir = os.path.join(self.disk_dir, "blobs")
+        for root, _, files in os.walk(blobs_dir):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                st = os.stat(os.path.join(root, name))
+                entries.append((st.st_mtime, name, st.st_size))
+        return entries
+
+    async def _ensure_disk_index(self):
+        """Rebuild the disk LRU from a previous run, oldest access first."""
+        async with self._disk_lock:
+            if self._disk_loaded:
+                return
+            try:
+                entries = await asyncio.to_thread(self._scan_disk)
+            except OSError:
+                entries = []
+            for _, digest, size in sorted(entries):
+                if digest not in self._disk:
+                    self._disk[digest] = size
+                    self._disk_bytes += size
+            self._disk_loaded = True
+
+    def _disk_read(self, url: str) -> Optional[tuple]:
+        try:
+            with open(self._url_path(url)) as f:
+                digest = f.read().strip()
+            path = self._blob_path(digest)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # keep LRU order across restarts
+            return digest, data
+        except OSError:
+            return None
+
+    def _disk_store(self, url: str, digest: str, data: Optional[bytes], evicted: list, src_path: Optional[str] = None):
+        """
+        File work for put()/spools: write the blob if new (from `data`, or by moving a
+        spooled file at `src_path`), write the URL pointer and drop evicted blobs.
+        """
+        path = self._blob_path(digest)
+        if data is not None or src_path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if data is not None:
+            tmp = f"{path}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        elif src_path is not None:
+            os.replace(src_path, path)
+        url_path = self._url_path(url)
+        os.makedirs(os.path.dirname(url_path), exist_ok=True)
+        with open(url_path, "w") as f:
+            f.write(digest)
+        for old_digest in evicted:
+            try:
+                os.remove(self._blob_path(old_digest))
+            except OSError:
+                pass
+
+    async def _disk_add(self, url: str, digest: str, size: int, data: Optional[bytes] = None,
+                        src_path: Optional[str] = None):
+        """Account for a blob in the disk LRU, evict past the limit, then do the file work."""
+        await self._ensure_disk_index()
+        is_new = digest not in self._disk
+        if is_new:
+            self._disk[digest] = size
+            self._disk_bytes += size
+        self._disk.move_to_end(digest)
+        evicted = []
+        while self._disk_bytes > self.disk_limit and len(self._disk) > 1:
+            old_digest, old_size = self._disk.popitem(last=False)
+            self._disk_bytes -= old_size
+            evicted.append(old_digest)
+        self.stats["disk_evictions"] += len(evicted)
+        try:
+            await asyncio.to_thread(
+                self._disk_store, url, digest,
+                data if is_new else None, evicted,
+                src_path if is_new else None,
+            )
+        except OSError as e:
+            logging.warning(f"Image cache disk write failed: {str(e)}")
+        if src_path is not None and not is_new:
+            try:
+                os.remove(src_path)
+            except OSError:
+                pass
+
+    # ---- memory tier ----
+    def _memory_put(self, digest: str, data: bytes):
+        if len(data) > self.memory_limit:
+            return
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            return
+        self._memory[digest] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.memory_limit:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old)
+            self.stats["memory_evictions"] += 1
+
+    # ---- public API ----
+    async def get(self, url: str) -> Optional[bytes]:
+        """Cached bytes for `url`, or None. Disk hits are promoted to memory."""
+        digest = self._urls.get(url)
+        if digest is not None and digest in self._memory:
+            self._memory.move_to_end(digest)
+            data = self._memory[digest]
+            self.stats["memory_hits"] += 1
+            self.stats["bytes_served_from_cache"] += len(data)
+            return data
+
+        await self._ensure_disk_index()
+        found = await asyncio.to_thread(self._disk_read, url)
+        if found is None:
+            return None
+        digest, data = found
+        if digest not in self._disk:
+            return None  # evicted while the read was in flight
+        self._disk.move_to_end(digest)
+        self._urls[url] = digest
+        self._memory_put(digest, data)
+        self.stats["disk_hits"] += 1
+        self.stats["bytes_served_from_cache"] += len(data)
+        return data
+
+    async def put(self, url: str, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        self._urls[url] = digest
+        self._memory_put(digest, data)
+        if len(data) <= self.disk_limit:
+            await self._disk_add(url, digest, len(data), data=data)
+        return digest
+
+    def spool(self, url: str) -> "ImageSpool":
+        """Writer that tees a streamed download to disk without holding it in memory."""
+        return ImageSpool(self, url)
+
+    async def fetch(self, session, url: str) -> Optional[bytes]:
+        """
+        Return the image at `url`, downloading it only on a cache miss. Concurrent
+        misses for the same URL share a single download.
+        """
+        data = await self.get(url)
+        if data is not None:
+            return data
+        return await self.download(session, url)
+
+    async def download(self, session, url: str) -> Optional[bytes]:
+        """Download `url` into the cache, sharing the request with concurrent callers."""
+        pending = self._downloads.get(url)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._downloads[url] = future
+        data = None
+        try:
+            self.stats["misses"] += 1
+            async with session.get(url) as img_response:
+                if img_response.status != 200:
+                    logging.error(f"Failed to download image from URL: {url}")
+                else:
+                    data = await img_response.read()
+                    self.stats["bytes_downloaded"] += len(data)
+                    await self.put(url, data)
+        except Exception as e:
+            logging.error(f"Error downloading image {url}: {str(e)}")
+        finally:
+            future.set_result(data)
+            self._downloads.pop(url, None)
+        return data
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_limit": self.memory_limit,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "disk_limit": self.disk_limit,
+        }
+
+
+class ImageSpool:
+    """
+    Disk-backed sink for an image that is being relayed in chunks. On commit the
+    spooled file becomes a regular disk-tier blob, so the next repost is a cache hit.
+    """
+
+    def __init__(self, cache: ImageCache, url: str):
+        self.cache = cache
+        self.url = url
+        self.size = 0
+        self._hasher = hashlib.sha256()
+        self._path = os.path.join(cache.disk_dir, "tmp", f"{uuid.uuid4().hex}.part")
+        self._file = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        self._file = open(self._path, "wb")
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        self._hasher.update(chunk)
+        if self.size > self.cache.disk_limit:
+            return  # too large for the disk tier; keep hashing, commit() will discard
+        if self._file is None:
+            await asyncio.to_thread(self._open)
+        await asyncio.to_thread(self._file.write, chunk)
+
+    async def commit(self) -> Optional[str]:
+        if self._file is None or self.size > self.cache.disk_limit:
+            await self.discard()
+            return None
+        await asyncio.to_thread(self._file.close)
+        digest = self._hasher.hexdigest()
+        self.cache._urls[self.url] = digest
+        await self.cache._disk_add(self.url, digest, self.size, src_path=self._path)
+        return digest
+
+    async def discard(self):
+        if self._file is not None:
+            self._file.close()
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+        self._file = None
+
+
+# Shared instance used by the posting routes
+image_cache = ImageCache(IMAGE_CACHE_MEMORY_BYTES, IMAGE_CACHE_DISK_BYTES, IMAGE_CACHE_DIR)
@@ -0,0 +1,367 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from utils.auth import tenant_id_for
+from utils.inventory_columns import InventoryColumns
+from utils.pagination import LISTING_PAGE_SIZE, LISTING_PAGE_WINDOW, PageFetchError, iter_pages
+from utils.upstream import BASE_URL, upstream_request
+
+# Shared per-account snapshot of the onsale inventory.
+#
+# /count-listings, /gameflip/listings and /delete-old-listings all read the same
+# snapshot instead of each paging through the whole inventory. A snapshot is served
+# for INVENTORY_TTL seconds; after that it is delta-synced: the search is walked in
+# updated:desc order and only listings created or updated since the snapshot's
+# watermark are fetched and merged. Removals (sold, expired, deleted elsewhere) do not
+# show up in that walk, so every INVENTORY_RECONCILE seconds the live count is probed
+# (see gallop_count) and compared with the snapshot; a mismatch, or an age of
+# INVENTORY_FULL_REFRESH seconds, triggers a full re-download. Our own posts mark the
+# snapshot stale and our own drafts/deletes remove the listings from it directly.
+# Analytics read a columnar copy of the snapshot (see utils/inventory_columns), rebuilt
+# only when the snapshot's version has moved on.
+
+INVENTORY_TTL = float(os.getenv("INVENTORY_TTL", "30"))
+INVENTORY_RECONCILE = float(os.getenv("INVENTORY_RECONCILE", "120"))
+INVENTORY_FULL_REFRESH = float(os.getenv("INVENTORY_FULL_REFRESH", "3600"))
+
+LISTINGS_ENDPOINT = f"{BASE_URL}/listing"
+DELTA_SYNC_WINDOW = 2   # pages in flight during a delta sync, which usually ends on the first
+
+# Listing fields kept in the snapshot
+SNAPSHOT_FIELDS = ("id", "name", "price", "created", "updated", "description",
+                   "platform", "category", "tags", "status")
+
+
+def parse_timestamp(value: Optional[str]) -> float:
+    """Epoch seconds of a Gameflip timestamp such as 2025-02-08T13:07:14.123Z."""
+    if not value:
+        return 0.0
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return 0.0
+
+
+async def fetch_listing_page(session, api_key: str, api_secret: str,
+                             params: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+    """One page of the listing search, or None if it could not be fetched."""
+    result = await upstream_request(session, "GET", LISTINGS_ENDPOINT, (api_key, api_secret), params=params)
+    if result.ok and isinstance(result.data, dict) and "data" in result.data:
+        return result.data["data"]
+    logging.error(f"Listing search failed at start={params.get('start')} ({result.error}): {result.data}")
+    return None
+
+
+async def gallop_count(session, api_key: str, api_secret: str, account_id: str,
+                       page_size: int = LISTING_PAGE_SIZE) -> Tuple[Optional[int], int]:
+    """
+    Count the onsale listings without downloading them: probe page starts with limit=1,
+    doubling the page index until a probe comes back empty, binary-search the last
+    non-empty page, then fetch only that page. Returns (count, requests made); count is
+    None if the upstream answered inconsistently and a full scan is needed.
+    """
+    requests = 0
+
+    async def fetch(start: int, limit: int) -> List[Dict[str, Any]]:
+        nonlocal requests
+        requests += 1
+        params = {"owner": account_id, "start": start, "limit": limit, "status": "onsale"}
+        page = await fetch_listing_page(session, api_key, api_secret, params)
+        if page is None:
+            raise PageFetchError(start)
+        return page
+
+    async def has_page(index: int) -> bool:
+        return bool(await fetch(index * page_size, 1))
+
+    if not await has_page(0):
+        return 0, requests
+    last, empty = 0, 1
+    while await has_page(empty):
+        last, empty = empty, empty * 2
+    while empty - last > 1:
+        middle = (last + empty) // 2
+        if await has_page(middle):
+            last = middle
+        else:
+            empty = middle
+
+    boundary = await fetch(last * page_size, page_size)
+    if not boundary:
+        # The probes saw this page but the full fetch did not
+        return None, requests
+    return last * page_size + len(boundary), requests
+
+
+class InventorySnapshot:
+    def __init__(self, account_id: str):
+        self.account_id = account_id
+        self.listings: Dict[str, Dict[str, Any]] = {}
+        self.watermark = 0.0        # newest created/updated time held, epoch seconds
+        self.refreshed = 0.0        # monotonic time of the last refresh
+        self.full_refreshed = 0.0   # monotonic time of the last full download
+        self.reconciled = 0.0       # monotonic time of the last count check
+        self.stale = True
+        self.last_pages = 0         # pages fetched by the last refresh
+        self.discarded: set = set()  # IDs removed by us while a full download is running
+        self.version = 0            # bumped on every change to `listings`
+        self._columns = None        # (version, InventoryColumns)
+        self.lock = asyncio.Lock()
+
+    def add(self, listing: Dict[str, Any]) -> bool:
+        """Store a listing; returns False if it was already held."""
+        listing_id = listing.get("id")
+        if not listing_id:
+            return False
+        held = self.listings.get(listing_id)
+        record = {field: listing.get(field) for field in SNAPSHOT_FIELDS}
+        record["created_ts"] = parse_timestamp(record["created"])
+        record["updated_ts"] = parse_timestamp(record["updated"]) or record["created_ts"]
+        if record == held:
+            return False
+        self.listings[listing_id] = record
+        self.version += 1
+        self.watermark = max(self.watermark, record["updated_ts"])
+        return held is None
+
+    def values(self) -> List[Dict[str, Any]]:
+        return list(self.listings.values())
+
+    def columns(self) -> InventoryColumns:
+        """The snapshot as NumPy columns, built once per version."""
+        if self._columns is None or self._columns[0] != self.version:
+            self._columns = (self.version, InventoryColumns(self.values()))
+        return self._columns[1]
+
+    def __len__(self) -> int:
+        return len(self.listings)
+
+    def needs_refresh(self) -> bool:
+        return self.stale or time.monotonic() - self.refreshed > INVENTORY_TTL
+
+    def needs_full_refresh(self) -> bool:
+        return not self.full_refreshed or time.monotonic() - self.full_refreshed > INVENTORY_FULL_REFRESH
+
+    def needs_reconcile(self) -> bool:
+        return time.monotonic() - self.reconciled > INVENTORY_RECONCILE
+
+
+class InventoryCache:
+    def __init__(self):
+        self._snapshots: Dict[str, InventorySnapshot] = {}
+        self._fills: set = set()   # running iter_listings downloads
+        self.stats = {"hits": 0, "delta_syncs": 0, "full_refreshes": 0, "pages_fetched": 0,
+                      "reconciliations": 0, "reconcile_mismatches": 0}
+
+    def _snapshot(self, api_key: str, account_id: str) -> InventorySnapshot:
+        key = tenant_id_for(api_key)
+        snapshot = self._snapshots.get(key)
+        if snapshot is None or snapshot.account_id != account_id:
+            snapshot = InventorySnapshot(account_id)
+            self._snapshots[key] = snapshot
+        return snapshot
+
+    async def get(self, session, api_key: str, api_secret: str, account_id: str,
+                  window: int = LISTING_PAGE_WINDOW) -> InventorySnapshot:
+        """
+        The onsale inventory of `account_id`, refreshed if stale. Concurrent callers
+        share one refresh. Raises PageFetchError if a page could not be fetched.
+        """
+        snapshot = self._snapshot(api_key, account_id)
+        async with snapshot.lock:
+            await self._refresh(session, api_key, api_secret, snapshot, window)
+            return snapshot
+
+    async def iter_listings(self, session, api_key: str, api_secret: str, account_id: str,
+                            window: int = LISTING_PAGE_WINDOW) -> AsyncIterator[List[Dict[str, Any]]]:
+        """
+        Like get(), but yields the inventory a page at a time. When a full download is
+        due the pages are passed on as they arrive instead of after the whole walk. The
+        download runs in its own task, so the snapshot lock is never held while the
+        caller (e.g. a slow streaming client) consumes a page.
+        """
+        snapshot = self._snapshot(api_key, account_id)
+        pages: asyncio.Queue = asyncio.Queue()
+
+        async def fill():
+            try:
+                async with snapshot.lock:
+                    if snapshot.needs_refresh() and snapshot.needs_full_refresh():
+                        async for page in self._download(session, api_key, api_secret, snapshot, window):
+                            pages.put_nowait(page)
+                        return
+                    await self._refresh(session, api_key, api_secret, snapshot, window)
+                    listings = snapshot.values()
+                for i in range(0, len(listings), LISTING_PAGE_SIZE):
+                    pages.put_nowait(listings[i:i + LISTING_PAGE_SIZE])
+            except Exception as e:
+                pages.put_nowait(e)
+            finally:
+                pages.put_nowait(None)
+
+        # Kept referenced until done; it finishes the download even if the caller stops
+        task = asyncio.create_task(fill())
+        self._fills.add(task)
+        task.add_done_callback(self._fills.discard)
+        while True:
+            page = await pages.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+
+    async def older_than(self, session, api_key: str, api_secret: str, account_id: str, cutoff: float,
+                         window: int = LISTING_PAGE_WINDOW) -> List[Dict[str, Any]]:
+        """
+        Listings created before `cutoff` (epoch seconds), oldest first. Served from the
+        snapshot when it is fresh; otherwise the search is walked in created:asc order and
+        stopped at the first listing past the cutoff, so only the old part is scanned.
+        """
+        snapshot = self._snapshot(api_key, account_id)
+        if not snapshot.needs_refresh():
+            self.stats["hits"] += 1
+            old = [listing for listing in snapshot.values() if listing["created_ts"] < cutoff]
+            return sorted(old, key=lambda listing: listing["created_ts"])
+
+        scanned = InventorySnapshot(account_id)
+        candidates = []
+        walk = self._pages(session, api_key, api_secret, account_id, window, sort="created:asc")
+        try:
+            async for page in walk:
+                past_cutoff = False
+                for listing in page:
+                    if not scanned.add(listing):
+                        continue
+                    record = scanned.listings[listing["id"]]
+                    if record["created_ts"] >= cutoff:
+                        past_cutoff = True
+                        break
+                    candidates.append(record)
+                if past_cutoff:
+                    break
+        finally:
+            await walk.aclose()
+        return candidates
+
+    async def _refresh(self, session, api_key, api_secret, snapshot: InventorySnapshot, window: int):
+        if not snapshot.needs_refresh():
+            self.stats["hits"] += 1
+        elif snapshot.needs_full_refresh():
+            async for _ in self._download(session, api_key, api_secret, snapshot, window):
+                pass
+        else:
+            await self._delta_sync(session, api_key, api_secret, snapshot, window)
+            if snapshot.needs_reconcile():
+                await self._reconcile(session, api_key, api_secret, snapshot, window)
+
+    def _pages(self, session, api_key: str, api_secret: str, account_id: str, window: int,
+               sort: str = "created:desc"):
+        async def fetch_page(start: int):
+            params = {"owner": account_id, "start": start, "limit": LISTING_PAGE_SIZE,
+                      "status": "onsale", "sort": sort}
+            page = await fetch_listing_page(session, api_key, api_secret, params)
+            self.stats["pages_fetched"] += 1
+            return page
+        return iter_pages(fetch_page, LISTING_PAGE_SIZE, window)
+
+    async def _download(self, session, api_key, api_secret, snapshot: InventorySnapshot, window: int):
+        """Full download into a new index, swapped in once the walk completes. Yields each page's records."""
+        fresh = InventorySnapshot(snapshot.account_id)
+        snapshot.discarded.clear()
+        pages = 0
+        async for page in self._pages(session, api_key, api_secret, snapshot.account_id, window):
+            pages += 1
+            # A listing posted during the walk shifts the rest down a position, so a page
+            # can repeat one already seen; each ID is passed on only once
+            yield [fresh.listings[listing["id"]] for listing in page if fresh.add(listing)]
+        # Listings we drafted or deleted during the walk may still be in its pages
+        for listing_id in snapshot.discarded:
+            fresh.listings.pop(listing_id, None)
+        snapshot.discarded.clear()
+        snapshot.listings = fresh.listings
+        snapshot.version += 1
+        snapshot.watermark = fresh.watermark
+        snapshot.full_refreshed = snapshot.refreshed = snapshot.reconciled = time.monotonic()
+        snapshot.stale = False
+        snapshot.last_pages = pages
+        self.stats["full_refreshes"] += 1
+        logging.info(f"Inventory of {snapshot.account_id} downloaded: {len(snapshot)} listings in {pages} pages")
+
+    async def _delta_sync(self, session, api_key, api_secret, snapshot: InventorySnapshot, window: int):
+        # Most recently changed first: stop at the first page that reaches below the watermark
+        watermark = snapshot.watermark
+        pages, changed = 0, 0
+        walk = self._pages(session, api_key, api_secret, snapshot.account_id, min(window, DELTA_SYNC_WINDOW),
+                           sort="updated:desc")
+        try:
+            async for page in walk:
+                pages += 1
+                reached = False
+                for listing in page:
+                    updated = parse_timestamp(listing.get("updated")) or parse_timestamp(listing.get("created"))
+                    if updated < watermark or (updated == watermark and listing.get("id") in snapshot.listings):
+                        reached = True
+                        continue
+                    snapshot.add(listing)
+                    changed += 1
+                if reached:
+                    break
+        finally:
+            await walk.aclose()
+        snapshot.refreshed = time.monotonic()
+        snapshot.stale = False
+        snapshot.last_pages = pages
+        self.stats["delta_syncs"] += 1
+        logging.info(f"Inventory of {snapshot.account_id} synced: {changed} new or updated listings in {pages} pages")
+
+    async def _reconcile(self, session, api_key, api_secret, snapshot: InventorySnapshot, window: int):
+        """Compare the live onsale count with the snapshot; re-download on a mismatch."""
+        self.stats["reconciliations"] += 1
+        live_count, _ = await gallop_count(session, api_key, api_secret, snapshot.account_id)
+        snapshot.reconciled = time.monotonic()
+        if live_count == len(snapshot):
+            return
+        self.stats["reconcile_mismatches"] += 1
+        logging.info(f"Inventory of {snapshot.account_id} out of sync ({live_count} live, "
+                     f"{len(snapshot)} held), downloading it again")
+        async for _ in self._download(session, api_key, api_secret, snapshot, window):
+            pass
+
+    def refresh_kind(self, api_key: str, account_id: str) -> str:
+        """What the next read would do: "fresh" (served as is), "delta" or "full"."""
+        snapshot = self._snapshot(api_key, account_id)
+        if not snapshot.needs_refresh():
+            return "fresh"
+        return "full" if snapshot.needs_full_refresh() else "delta"
+
+    # ---- hooks for our own writes ----
+    def invalidate(self, api_key: Optional[str]):
+        """Mark the account's snapshot stale, e.g. after posting a listing."""
+        snapshot = self._snapshots.get(tenant_id_for(api_key or ""))
+        if snapshot is not None:
+            snapshot.stale = True
+
+    def discard(self, api_key: Optional[str], listing_ids: Iterable[str]):
+        """Drop listings we drafted or deleted from the account's snapshot."""
+        snapshot = self._snapshots.get(tenant_id_for(api_key or ""))
+        if snapshot is not None:
+            for listing_id in listing_ids:
+                if snapshot.listings.pop(listing_id, None) is not None:
+                    snapshot.version += 1
+                if snapshot.lock.locked():
+                    snapshot.discarded.add(listing_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "accounts": len(self._snapshots),
+                "listings": sum(len(s) for s in self._snapshots.values())}
+
+
+# Shared instance used by the inventory routes
+inventory = InventoryCache()
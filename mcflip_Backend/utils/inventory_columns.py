@@ -0,0 +1,86 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+# Columnar view of an inventory snapshot for vectorized queries.
+#
+# Built once per snapshot version: created time and price as float64 arrays, category
+# and platform as int32 codes into small lookup lists. Age filters, histograms,
+# quantiles and per-category counts are then single NumPy passes, which keeps
+# 100k-listing accounts in the millisecond range.
+
+# Age buckets: (upper bound in seconds, label)
+AGE_BUCKETS = [(3600, "<1h"), (6 * 3600, "1-6h"), (24 * 3600, "6-24h"), (3 * 86400, "1-3d"),
+               (7 * 86400, "3-7d"), (30 * 86400, "7-30d"), (float("inf"), ">30d")]
+PRICE_QUANTILES = (0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+
+def _encode(values: Iterable[Optional[str]]) -> Tuple[np.ndarray, List[str]]:
+    labels: Dict[str, int] = {}
+    codes = [labels.setdefault(value or "", len(labels)) for value in values]
+    return np.asarray(codes, dtype=np.int32), list(labels)
+
+
+class InventoryColumns:
+    def __init__(self, records: List[Dict[str, Any]]):
+        self.ids = np.asarray([r["id"] for r in records], dtype=object)
+        self.created = np.fromiter((r["created_ts"] for r in records), dtype=np.float64, count=len(records))
+        self.price = np.fromiter((float(r.get("price") or 0) for r in records), dtype=np.float64, count=len(records))
+        self.category_codes, self.categories = _encode(r.get("category") for r in records)
+        self.platform_codes, self.platforms = _encode(r.get("platform") for r in records)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def ages(self, now: float) -> np.ndarray:
+        return now - self.created
+
+    def older_than(self, now: float, seconds: float) -> np.ndarray:
+        """Indices of listings older than `seconds`, oldest first."""
+        indices = np.flatnonzero(self.ages(now) > seconds)
+        return indices[np.argsort(self.created[indices], kind="stable")]
+
+    def age_histogram(self, now: float, indices: Optional[np.ndarray] = None) -> Dict[str, int]:
+        ages = self.ages(now) if indices is None else self.ages(now)[indices]
+        edges = np.asarray([bound for bound, _ in AGE_BUCKETS[:-1]])
+        counts = np.bincount(np.searchsorted(edges, ages, side="left"), minlength=len(AGE_BUCKETS))
+        return {label: int(count) for (_, label), count in zip(AGE_BUCKETS, counts)}
+
+    def price_quantiles(self, mask: Optional[np.ndarray] = None) -> Dict[str, float]:
+        prices = self.price if mask is None else self.price[mask]
+        if not len(prices):
+            return {}
+        values = np.quantile(prices, PRICE_QUANTILES)
+        summary = {f"p{int(q * 100)}": float(v) for q, v in zip(PRICE_QUANTILES, values)}
+        summary["mean"] = float(prices.mean())
+        return summary
+
+    def analytics(self, now: float, older_than: Optional[float] = None) -> Dict[str, Any]:
+        """Age buckets, price quantiles and per-category counts (optionally only old listings)."""
+        old = self.ages(now) > older_than if older_than is not None else np.ones(len(self), dtype=bool)
+        per_category = np.bincount(self.category_codes, minlength=len(self.categories))
+        old_per_category = np.bincount(self.category_codes[old], minlength=len(self.categories))
+        # Median price per category: sort by (category, price) once and take each run's middle
+        order = np.lexsort((self.price, self.category_codes))
+        starts = np.concatenate(([0], np.cumsum(per_category)[:-1]))
+        sorted_prices = self.price[order]
+        categories = {}
+        for code, name in enumerate(self.categories):
+            count = int(per_category[code])
+            if not count:
+                continue
+            run = sorted_prices[starts[code]:starts[code] + count]
+            categories[name or "unknown"] = {
+                "count": count,
+                "older": int(old_per_category[code]),
+                "median_price": float(np.median(run)),
+            }
+        per_platform = np.bincount(self.platform_codes, minlength=len(self.platforms))
+        return {
+            "total": len(self),
+            "older": int(old.sum()),
+            "age_buckets": self.age_histogram(now),
+            "price": self.price_quantiles(),
+            "older_price": self.price_quantiles(old),
+            "categories": categories,
+            "platforms": {(name or "unknown"): int(count) for name, count in zip(self.platforms, per_platform)},
+        }
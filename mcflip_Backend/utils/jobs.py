@@ -0,0 +1,105 @@
+import os
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Background jobs for long-running sweeps.
+#
+# A job is started right away and runs as an asyncio task, at most
+# `concurrency` at a time; the rest wait their turn. Its progress object is
+# read live by the status endpoint, it can be cancelled mid-run, and the summaries of
+# the last JOB_HISTORY finished jobs are kept for inspection.
+
+JOB_HISTORY = int(os.getenv("JOB_HISTORY", "100"))
+
+QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED = "queued", "running", "completed", "failed", "cancelled"
+
+
+class Job:
+    def __init__(self, kind: str, progress: Any, params: Dict[str, Any]):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.progress = progress          # object with as_dict(), updated by the job itself
+        self.params = params
+        self.state = QUEUED
+        self.created = datetime.now()
+        self.started: Optional[datetime] = None
+        self.finished: Optional[datetime] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def done(self) -> bool:
+        return self.state in (COMPLETED, FAILED, CANCELLED)
+
+    def as_dict(self) -> Dict[str, Any]:
+        end = self.finished or datetime.now()
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "state": self.state,
+            "params": self.params,
+            "progress": self.progress.as_dict(),
+            "result": self.result,
+            "error": self.error,
+            "created": self.created.isoformat(),
+            "started": self.started.isoformat() if self.started else None,
+            "finished": self.finished.isoformat() if self.finished else None,
+            "duration": str(end - self.started) if self.started else None
+        }
+
+
+class JobRegistry:
+    def __init__(self, concurrency: int, history: int = JOB_HISTORY):
+        self.history = history
+        self._slots = asyncio.Semaphore(concurrency)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+
+    def start(self, kind: str, progress: Any, params: Dict[str, Any],
+              run: Callable[[Any], Awaitable[Any]]) -> Job:
+        """Start `run(progress)` in the background and return its job right away."""
+        job = Job(kind, progress, params)
+        self._jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run(job, run))
+        self._prune()
+        return job
+
+    async def _run(self, job: Job, run: Callable[[Any], Awaitable[Any]]):
+        try:
+            async with self._slots:
+                job.state = RUNNING
+                job.started = datetime.now()
+                job.result = await run(job.progress)
+                job.state = COMPLETED
+        except asyncio.CancelledError:
+            job.state = CANCELLED
+        except Exception as e:
+            job.state = FAILED
+            job.error = str(e)
+            logging.error(f"Job {job.job_id} ({job.kind}) failed: {str(e)}")
+        finally:
+            job.finished = datetime.now()
+            if job.started is None:
+                job.started = job.finished
+            self._prune()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is not None and not job.done and job.task is not None:
+            job.task.cancel()
+        return job
+
+    def list(self) -> List[Job]:
+        return list(self._jobs.values())
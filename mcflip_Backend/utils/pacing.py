@@ -0,0 +1,51 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class PacingBudget:
+    """
+    Shared start-rate budget (listings per minute) for a pool of workers.
+
+    Each acquire() reserves the next free start slot, so N workers together never
+    start more than `per_minute` operations per minute, while a slow operation
+    only holds its own worker instead of delaying the next slot.
+    """
+
+    def __init__(self, per_minute: Optional[float] = None):
+        self.per_minute = per_minute
+        self._next_slot = 0.0
+
+    @property
+    def interval(self) -> float:
+        if not self.per_minute or self.per_minute <= 0:
+            return 0.0
+        return 60.0 / self.per_minute
+
+    def set_rate(self, per_minute: Optional[float]):
+        self.per_minute = per_minute
+
+    def seconds_until_ready(self) -> float:
+        return max(0.0, self._next_slot - time.monotonic())
+
+    def reserve(self) -> float:
+        """Claim the next slot and return how long the caller must wait for it."""
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        return slot - now
+
+    async def acquire(self, stop_event: Optional[asyncio.Event] = None) -> bool:
+        """Wait for the next slot. Returns False if `stop_event` fired while waiting."""
+        delay = self.reserve()
+        if stop_event is None:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return True
+        if stop_event.is_set():
+            return False
+        try:
+            await asyncio.wait_for(stop_event.wait(), timeout=delay)
+            return False
+        except asyncio.TimeoutError:
+            return True
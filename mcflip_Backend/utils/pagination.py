@@ -0,0 +1,50 @@
+import os
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+# Concurrent offset pagination for the Gameflip listing search.
+#
+# A window of `start` offsets is kept in flight ahead of the consumer. Pages are
+# yielded strictly in offset order; at most `window` pages are held at once. The first
+# short or empty page marks the end of data and every speculative request past it is
+# cancelled. A page that cannot be fetched raises PageFetchError rather than passing
+# for the end of data.
+
+LISTING_PAGE_SIZE = 100
+LISTING_PAGE_WINDOW = int(os.getenv("LISTING_PAGE_WINDOW", "4"))
+
+# fetch_page(start) -> the page's items, or None when the page could not be fetched
+FetchPage = Callable[[int], Awaitable[Optional[List[Any]]]]
+
+
+class PageFetchError(Exception):
+    def __init__(self, start: int):
+        super().__init__(f"Failed to fetch listing page at start={start}")
+        self.start = start
+
+
+async def iter_pages(fetch_page: FetchPage, page_size: int = LISTING_PAGE_SIZE,
+                     window: int = LISTING_PAGE_WINDOW, start: int = 0) -> AsyncIterator[List[Any]]:
+    pending: Dict[int, asyncio.Task] = {}
+    next_offset = start
+    offset = start
+    try:
+        while True:
+            while len(pending) < max(1, window):
+                pending[next_offset] = asyncio.create_task(fetch_page(next_offset))
+                next_offset += page_size
+            page = await pending.pop(offset)
+            if page is None:
+                raise PageFetchError(offset)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            offset += page_size
+    finally:
+        for task in pending.values():
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending.values(), return_exceptions=True)
+
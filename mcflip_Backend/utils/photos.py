@@ -0,0 +1,205 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional
+from pydantic import BaseModel
+from utils.image_cache import image_cache
+
+# Photo pipeline shared by the posting routes.
+#
+# Every image is staged concurrently (request upload URL, fetch, PUT), then the
+# photo metadata, cover photo and final listing status go out in one JSON-Patch
+# document, so posting latency is bounded by the slowest image instead of the sum.
+
+# Cache misses are relayed from the source URL to the upload URL in chunks, so
+# download and upload overlap and only a few chunks are held in memory at once.
+IMAGE_RELAY_STREAMING = os.getenv("IMAGE_RELAY_STREAMING", "1") == "1"
+IMAGE_RELAY_CHUNK_BYTES = int(os.getenv("IMAGE_RELAY_CHUNK_KB", "64")) * 1024
+IMAGE_MAX_BYTES = int(float(os.getenv("IMAGE_MAX_MB", "0")) * 1024 * 1024)  # 0 = no limit
+
+# request(method, endpoint, data=None) -> response dict, bound to the caller's credentials
+ApiRequest = Callable[..., Awaitable[Optional[dict]]]
+
+
+class PhotoData(BaseModel):
+    url: str
+    status: str = "active"
+    display_order: Optional[int] = None
+
+
+class PhotoUploadResult:
+    def __init__(self):
+        self.photo_ids: List[str] = []
+        self.main_photo_id: Optional[str] = None
+        self.failed_photos = 0
+        self.cover_ok = True
+        self.status_ok = False
+
+    @property
+    def errors(self) -> int:
+        return self.failed_photos + (0 if self.cover_ok else 1) + (0 if self.status_ok else 1)
+
+
+def listing_photos(image_url: Optional[str], additional_images: Optional[List[str]]) -> List[PhotoData]:
+    """Main image gets display_order 0, additional images follow from 1."""
+    photos = []
+    if image_url:
+        photos.append(PhotoData(url=image_url, status="active", display_order=0))
+    for index, img_url in enumerate(additional_images or [], start=1):
+        photos.append(PhotoData(url=img_url, status="active", display_order=index))
+    return photos
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+async def relay_image(session, source_url: str, upload_url: str,
+                      chunk_size: int = IMAGE_RELAY_CHUNK_BYTES, max_bytes: int = IMAGE_MAX_BYTES) -> bool:
+    """
+    Pipe the image at `source_url` into a PUT to `upload_url` chunk by chunk, teeing
+    it to the disk cache. Needs a Content-Length from the source since the storage
+    upload URL does not accept chunked bodies; without one the image is buffered.
+    """
+    image_cache.stats["misses"] += 1
+    async with session.get(source_url) as img_response:
+        if img_response.status != 200:
+            logging.error(f"Failed to download image from URL: {source_url}")
+            return False
+        length = img_response.content_length
+        if max_bytes and length and length > max_bytes:
+            logging.error(f"Image {source_url} is {length} bytes, over the {max_bytes} byte limit")
+            return False
+
+        if length is None:
+            image_data = await img_response.read()
+            if max_bytes and len(image_data) > max_bytes:
+                logging.error(f"Image {source_url} is over the {max_bytes} byte limit")
+                return False
+            image_cache.stats["bytes_downloaded"] += len(image_data)
+            await image_cache.put(source_url, image_data)
+            async with session.put(upload_url, data=image_data) as upload_response:
+                if upload_response.status != 200:
+                    logging.error(f"Failed to upload image to storage: {upload_response.status}")
+                    return False
+            return True
+
+        spool = image_cache.spool(source_url)
+
+        async def body():
+            async for chunk in img_response.content.iter_chunked(chunk_size):
+                if max_bytes and spool.size + len(chunk) > max_bytes:
+                    raise ImageTooLarge(f"Image {source_url} is over the {max_bytes} byte limit")
+                await spool.write(chunk)
+                image_cache.stats["bytes_downloaded"] += len(chunk)
+                yield chunk
+
+        try:
+            async with session.put(upload_url, data=body(), headers={"Content-Length": str(length)}) as upload_response:
+                if upload_response.status != 200:
+                    logging.error(f"Failed to upload image to storage: {upload_response.status}")
+                    await spool.discard()
+                    return False
+        except Exception:
+            await spool.discard()
+            raise
+        if spool.size == length:
+            await spool.commit()
+        else:
+            await spool.discard()
+        return True
+
+
+async def stage_photo(session, request: ApiRequest, listing_id: str, photo_data: PhotoData) -> Optional[str]:
+    """Create a photo slot on the listing and upload the image bytes to it. Returns the photo ID."""
+    try:
+        # 1) Request an upload URL
+        photo_response = await request('POST', f'/listing/{listing_id}/photo')
+        if not photo_response or photo_response.get('status') != 'SUCCESS':
+            logging.error(f"Failed to get photo upload URL: {photo_response}")
+            return None
+        upload_url = photo_response.get('data', {}).get('upload_url')
+        photo_id = photo_response.get('data', {}).get('id')
+        if not upload_url or not photo_id:
+            logging.error("Missing upload URL or photo ID")
+            return None
+        # 2) Get the image bytes from the cache; on a miss, relay the download
+        #    straight into the upload (or download it whole when streaming is off)
+        image_data = await image_cache.get(photo_data.url)
+        if image_data is None:
+            if IMAGE_RELAY_STREAMING:
+                return photo_id if await relay_image(session, photo_data.url, upload_url) else None
+            image_data = await image_cache.download(session, photo_data.url)
+            if image_data is None:
+                return None
+        # 3) PUT the image data to the upload_url
+        async with session.put(upload_url, data=image_data) as upload_response:
+            if upload_response.status != 200:
+                logging.error(f"Failed to upload image to storage: {upload_response.status}")
+                return None
+        return photo_id
+    except Exception as e:
+        logging.error(f"Error staging photo {photo_data.url}: {str(e)}")
+        return None
+
+
+def build_patch_ops(staged: List[tuple], cover_photo_id: Optional[str], status: Optional[str]) -> List[dict]:
+    """One JSON-Patch document for photo status/display_order, cover photo and listing status."""
+    patch_ops = []
+    for photo_id, photo_data in staged:
+        if photo_data.status:
+            patch_ops.append({"op": "replace", "path": f"/photo/{photo_id}/status", "value": photo_data.status})
+        if photo_data.display_order is not None:
+            patch_ops.append({"op": "replace", "path": f"/photo/{photo_id}/display_order", "value": photo_data.display_order})
+    if cover_photo_id:
+        patch_ops.append({"op": "replace", "path": "/cover_photo", "value": cover_photo_id})
+    # Status goes last so the listing only goes on sale once its photos are in place
+    if status:
+        patch_ops.append({"op": "replace", "path": "/status", "value": status})
+    return patch_ops
+
+
+async def _patch(request: ApiRequest, listing_id: str, patch_ops: List[dict]) -> bool:
+    try:
+        patch_response = await request('PATCH', f'/listing/{listing_id}', data=patch_ops)
+        return bool(patch_response and patch_response.get('status') == 'SUCCESS')
+    except Exception as e:
+        logging.error(f"Error patching listing {listing_id}: {str(e)}")
+        return False
+
+
+async def upload_listing_photos(session, request: ApiRequest, listing_id: str, photos: List[PhotoData],
+                                status: Optional[str] = "onsale") -> PhotoUploadResult:
+    """
+    Upload all photos concurrently, then apply metadata, cover photo and `status` in a
+    single PATCH. If the combined document is rejected, fall back to photos + cover first
+    and status second, which is the order the listing used to be built in.
+    """
+    result = PhotoUploadResult()
+    photo_ids = await asyncio.gather(*(stage_photo(session, request, listing_id, p) for p in photos))
+
+    staged = []
+    for photo_id, photo_data in zip(photo_ids, photos):
+        if photo_id:
+            staged.append((photo_id, photo_data))
+            result.photo_ids.append(photo_id)
+            if photo_data.display_order == 0:
+                result.main_photo_id = photo_id
+        else:
+            result.failed_photos += 1
+            logging.warning(f"Failed to upload photo {photo_data.display_order} for listing {listing_id}")
+
+    if await _patch(request, listing_id, build_patch_ops(staged, result.main_photo_id, status)):
+        result.status_ok = True
+        return result
+
+    logging.warning(f"Combined patch rejected for listing {listing_id}, retrying as separate patches")
+    photo_ops = build_patch_ops(staged, result.main_photo_id, None)
+    if photo_ops and not await _patch(request, listing_id, photo_ops):
+        result.cover_ok = result.main_photo_id is None
+        logging.warning(f"Failed to update photo metadata for listing {listing_id}")
+    if status:
+        result.status_ok = await _patch(request, listing_id, build_patch_ops([], None, status))
+    else:
+        result.status_ok = True
+    return result
@@ -0,0 +1,205 @@
+import asyncio
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from utils.auth import tenant_id_for
+from utils.pacing import PacingBudget
+
+# Multi-tenant posting scheduler.
+#
+# Every seller credential (API key) is a tenant with its own listing batch, pacing
+# budget, stats and stop control. A shared pool of posting workers asks the scheduler
+# for the next job; tenants are served by deficit round-robin weighted by how much
+# work a listing costs (one create plus one upload per photo), so a tenant with a big
+# batch or many photos cannot starve the others.
+
+DEFAULT_QUANTUM = 4  # work units granted to a tenant per round
+
+
+class ListingState:
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self.is_active = True
+        self.start_time = datetime.now()
+        self.last_post_time = None
+        self.total_posts = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.listings_per_minute: Optional[float] = None
+        self.recent_posts: deque = deque()  # monotonic timestamps of posts in the last minute
+
+    def record_post(self):
+        self.total_posts += 1
+        self.last_post_time = datetime.now()
+        self.recent_posts.append(time.monotonic())
+
+    def posts_per_minute(self) -> int:
+        """Listings actually put on sale during the last 60 seconds."""
+        cutoff = time.monotonic() - 60
+        while self.recent_posts and self.recent_posts[0] < cutoff:
+            self.recent_posts.popleft()
+        return len(self.recent_posts)
+
+
+class Tenant:
+    def __init__(self, api_key: str, api_secret: str, listings_per_minute: Optional[float]):
+        self.tenant_id = tenant_id_for(api_key)
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.batch: List[Any] = []
+        self.cursor = 0
+        self.in_flight: List[int] = []   # batch positions taken but not yet attempted, oldest first
+        self.deficit = 0
+        self.pacer = PacingBudget(listings_per_minute)
+        self.state = ListingState(task_id=f"tenant:{self.tenant_id}")
+        self.state.listings_per_minute = listings_per_minute
+
+    @property
+    def active(self) -> bool:
+        return self.state.is_active
+
+    def has_work(self) -> bool:
+        return self.active and bool(self.batch)
+
+    def ready(self) -> bool:
+        return self.has_work() and self.pacer.seconds_until_ready() == 0
+
+    def peek(self) -> Any:
+        return self.batch[self.cursor % len(self.batch)]
+
+    def take(self) -> Any:
+        """Next listing in the batch; the batch is reposted in a loop until stopped."""
+        position = self.cursor % len(self.batch)
+        listing = self.batch[position]
+        self.cursor = (position + 1) % len(self.batch)
+        self.in_flight.append(position)
+        self.pacer.reserve()
+        return listing
+
+    def finish(self, listing: Any) -> int:
+        """
+        Mark a taken listing as attempted. Returns the cursor safe to persist: the
+        oldest listing still being posted, so a restart never skips an unposted one.
+        """
+        for i, position in enumerate(self.in_flight):
+            if position < len(self.batch) and self.batch[position] is listing:
+                del self.in_flight[i]
+                break
+        return self.in_flight[0] if self.in_flight else self.cursor
+
+    def set_rate(self, listings_per_minute: Optional[float]):
+        self.pacer.set_rate(listings_per_minute)
+        self.state.listings_per_minute = listings_per_minute
+
+    def stop(self):
+        self.state.is_active = False
+        self.batch.clear()
+        self.in_flight.clear()
+
+
+class PostingScheduler:
+    def __init__(self, cost: Callable[[Any], int], quantum: int = DEFAULT_QUANTUM):
+        self.cost = cost
+        self.quantum = quantum
+        self.tenants: Dict[str, Tenant] = {}
+        self._order: List[str] = []   # round-robin order of tenant IDs
+        self._pos = 0
+        self._turn_granted = False    # current tenant already got its quantum this round
+        self._wake = asyncio.Event()
+        self._closed = False
+
+    # ---- tenant management ----
+    def add_listing(self, api_key: str, api_secret: str, listing: Any,
+                    listings_per_minute: Optional[float]) -> Tenant:
+        tenant_id = tenant_id_for(api_key)
+        tenant = self.tenants.get(tenant_id)
+        if tenant is None or not tenant.active:
+            tenant = Tenant(api_key, api_secret, listings_per_minute)
+            self.tenants[tenant_id] = tenant
+            if tenant_id not in self._order:
+                self._order.append(tenant_id)
+        else:
+            tenant.api_secret = api_secret
+            tenant.set_rate(listings_per_minute)
+        tenant.batch.append(listing)
+        self._closed = False
+        self._wake.set()
+        return tenant
+
+    def stop_tenant(self, api_key: str) -> Optional[Tenant]:
+        tenant = self.tenants.get(tenant_id_for(api_key))
+        if tenant is None:
+            return None
+        tenant.stop()
+        self._drop(tenant.tenant_id)
+        self._wake.set()
+        return tenant
+
+    def stop_all(self) -> List[str]:
+        stopped = []
+        for tenant in list(self.tenants.values()):
+            tenant.stop()
+            stopped.append(tenant.state.task_id)
+        self.tenants.clear()
+        self._order.clear()
+        self._pos = 0
+        self._closed = True
+        self._wake.set()
+        return stopped
+
+    def _drop(self, tenant_id: str):
+        self.tenants.pop(tenant_id, None)
+        if tenant_id in self._order:
+            index = self._order.index(tenant_id)
+            self._order.remove(tenant_id)
+            if index < self._pos:
+                self._pos -= 1
+            self._turn_granted = False
+
+    def has_tenants(self) -> bool:
+        return any(t.active for t in self.tenants.values())
+
+    # ---- deficit round-robin ----
+    def _pick(self) -> Optional[Tuple[Tenant, Any]]:
+        if not self._order:
+            return None
+        max_cost = max((self.cost(t.peek()) for t in self.tenants.values() if t.ready()), default=0)
+        if max_cost == 0:
+            return None
+        # Enough steps for any ready tenant to accumulate the cost of its next listing
+        for _ in range(len(self._order) * (max_cost // self.quantum + 2)):
+            self._pos %= len(self._order)
+            tenant = self.tenants[self._order[self._pos]]
+            if tenant.ready():
+                cost = self.cost(tenant.peek())
+                if not self._turn_granted:
+                    # Cap the carried deficit so a paced-out tenant cannot bank a burst
+                    tenant.deficit = min(tenant.deficit + self.quantum, self.quantum + cost)
+                    self._turn_granted = True
+                if tenant.deficit >= cost:
+                    tenant.deficit -= cost
+                    return tenant, tenant.take()
+            elif not tenant.has_work():
+                tenant.deficit = 0
+            self._pos += 1
+            self._turn_granted = False
+        return None
+
+    def _next_ready_in(self) -> Optional[float]:
+        waits = [t.pacer.seconds_until_ready() for t in self.tenants.values() if t.has_work()]
+        return min(waits) if waits else None
+
+    async def next_job(self) -> Optional[Tuple[Tenant, Any]]:
+        """Wait for the next (tenant, listing) to post. Returns None once every tenant has stopped."""
+        while True:
+            if self._closed or not self.has_tenants():
+                return None
+            job = self._pick()
+            if job is not None:
+                return job
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self._next_ready_in() or 1.0)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,214 @@
+import os
+import asyncio
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Durable posting queue.
+#
+# Tenants (credentials + pacing) and their queued listings are kept in a local SQLite
+# database in WAL mode so a restart or deploy can resume posting where it stopped.
+# Writes are group-committed: callers queue statements, a single flusher commits
+# everything that arrived within POSTING_STORE_FLUSH_MS in one transaction, and every
+# waiting caller is released by that one fsync.
+#
+# Note: API secrets are stored as given so the background task can resume, so the
+# database file is created readable by the service user only (0600).
+
+POSTING_STORE_PATH = os.getenv("POSTING_STORE_PATH", ".data/posting_queue.db")
+POSTING_STORE_FLUSH_MS = float(os.getenv("POSTING_STORE_FLUSH_MS", "20"))
+POSTING_STORE_MAX_BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tenants (
+    tenant_id TEXT PRIMARY KEY,
+    api_key TEXT NOT NULL,
+    api_secret TEXT NOT NULL,
+    listings_per_minute REAL,
+    cursor INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS listings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tenant_id TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS listings_tenant ON listings (tenant_id, id);
+"""
+
+
+class PostingStore:
+    def __init__(self, path: str, flush_interval: float = POSTING_STORE_FLUSH_MS / 1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: List[Tuple[str, tuple, Optional[asyncio.Future]]] = []
+        self._cursors: Dict[str, int] = {}  # latest cursor per tenant, coalesced between flushes
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._start_lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self.stats = {"commits": 0, "statements": 0, "last_commit_ms": 0.0}
+
+    # ---- lifecycle ----
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Owner-only from the start; SQLite gives the WAL and shm files the same mode
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+        os.chmod(self.path, 0o600)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.executescript(SCHEMA)
+        self._conn = conn
+
+    async def start(self):
+        async with self._start_lock:
+            if self._task is not None:
+                return
+            await asyncio.to_thread(self._open)
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._flusher())
+            logging.info(f"Posting store opened at {self.path}")
+
+    async def close(self):
+        if self._task is None:
+            return
+        await self._flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    # ---- group commit ----
+    def _commit(self, ops: List[Tuple[str, tuple]], cursors: Dict[str, int]):
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            for sql, params in ops:
+                conn.execute(sql, params)
+            if cursors:
+                conn.executemany(
+                    "UPDATE tenants SET cursor = ? WHERE tenant_id = ?",
+                    [(cursor, tenant_id) for tenant_id, cursor in cursors.items()],
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def _flush(self):
+        async with self._flush_lock:
+            await self._flush_pending()
+
+    async def _flush_pending(self):
+        while self._pending or self._cursors:
+            batch = self._pending[:POSTING_STORE_MAX_BATCH]
+            del self._pending[:POSTING_STORE_MAX_BATCH]
+            cursors, self._cursors = self._cursors, {}
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(self._commit, [(sql, params) for sql, params, _ in batch], cursors)
+                error = None
+            except Exception as e:
+                logging.error(f"Posting store commit failed: {str(e)}")
+                error = e
+            self.stats["commits"] += 1
+            self.stats["statements"] += len(batch)
+            self.stats["last_commit_ms"] = round((time.monotonic() - started) * 1000, 2)
+            for _, _, future in batch:
+                if future is not None and not future.done():
+                    if error is None:
+                        future.set_result(None)
+                    else:
+                        future.set_exception(error)
+
+    async def _flusher(self):
+        while True:
+            await self._wake.wait()
+            # Give concurrent writers a moment to join this commit
+            await asyncio.sleep(self.flush_interval)
+            self._wake.clear()
+            await self._flush()
+
+    async def _execute(self, sql: str, params: tuple = (), wait: bool = True):
+        await self.start()
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._pending.append((sql, params, future))
+        self._wake.set()
+        if future is not None:
+            await future
+
+    # ---- queue operations ----
+    async def save_tenant(self, tenant_id: str, api_key: str, api_secret: str, listings_per_minute: Optional[float]):
+        await self._execute(
+            "INSERT INTO tenants (tenant_id, api_key, api_secret, listings_per_minute, cursor, updated) "
+            "VALUES (?, ?, ?, ?, 0, ?) ON CONFLICT(tenant_id) DO UPDATE SET "
+            "api_secret = excluded.api_secret, listings_per_minute = excluded.listings_per_minute, "
+            "updated = excluded.updated",
+            (tenant_id, api_key, api_secret, listings_per_minute, time.time()),
+        )
+
+    async def add_listing(self, tenant_id: str, payload: bytes):
+        """Durably queue a listing; returns once its commit is on disk."""
+        await self._execute(
+            "INSERT INTO listings (tenant_id, payload, created) VALUES (?, ?, ?)",
+            (tenant_id, payload, time.time()),
+        )
+
+    def save_cursor(self, tenant_id: str, cursor: int):
+        """Record how far through its batch a tenant is. Coalesced, not awaited."""
+        if self._task is None:
+            return
+        self._cursors[tenant_id] = cursor
+        self._wake.set()
+
+    async def remove_tenant(self, tenant_id: str):
+        self._cursors.pop(tenant_id, None)
+        await self._execute("DELETE FROM listings WHERE tenant_id = ?", (tenant_id,))
+        await self._execute("DELETE FROM tenants WHERE tenant_id = ?", (tenant_id,))
+
+    async def clear(self):
+        self._cursors.clear()
+        await self._execute("DELETE FROM listings")
+        await self._execute("DELETE FROM tenants")
+
+    def _load(self) -> List[Dict[str, Any]]:
+        tenants = []
+        rows = self._conn.execute(
+            "SELECT tenant_id, api_key, api_secret, listings_per_minute, cursor FROM tenants ORDER BY updated"
+        ).fetchall()
+        for tenant_id, api_key, api_secret, listings_per_minute, cursor in rows:
+            payloads = [
+                row[0] for row in self._conn.execute(
+                    "SELECT payload FROM listings WHERE tenant_id = ? ORDER BY id", (tenant_id,)
+                )
+            ]
+            tenants.append({
+                "tenant_id": tenant_id,
+                "api_key": api_key,
+                "api_secret": api_secret,
+                "listings_per_minute": listings_per_minute,
+                "cursor": cursor,
+                "payloads": payloads,
+            })
+        return tenants
+
+    async def load(self) -> List[Dict[str, Any]]:
+        """Every stored tenant with its queued listing payloads, in enqueue order."""
+        await self.start()
+        async with self._flush_lock:
+            return await asyncio.to_thread(self._load)
+
+
+# Shared instance used by the posting routes
+posting_store = PostingStore(POSTING_STORE_PATH)
@@ -0,0 +1,62 @@
+import sys
+import json
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+
+# Compact form of a listing waiting in a posting batch.
+#
+# The create-listing body is encoded to JSON bytes once when the listing is queued and
+# sent as-is on every repost, so a batch cycle does no model-to-dict conversion or JSON
+# encoding. Only the fields the posting loop reads are kept besides the payload, and
+# the strings repeated across a batch (category, platform, UPC, image URLs) are interned.
+
+# Fields sent in the photo pipeline instead of the create-listing body
+PHOTO_FIELDS = {"image_url", "additional_images"}
+
+
+def encode_json(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class QueuedListing:
+    __slots__ = ("payload", "image_url", "additional_images", "category", "platform", "upc")
+
+    def __init__(self, payload: bytes, image_url: Optional[str], additional_images: Tuple[str, ...],
+                 category: str, platform: str, upc: str):
+        self.payload = payload
+        self.image_url = image_url
+        self.additional_images = additional_images
+        self.category = category
+        self.platform = platform
+        self.upc = upc
+
+    @classmethod
+    def from_fields(cls, fields: Dict[str, Any]) -> "QueuedListing":
+        """Build from a validated listing dict (e.g. `ListingRequest.dict()`)."""
+        create_body = {k: v for k, v in fields.items() if k not in PHOTO_FIELDS}
+        return cls(
+            payload=encode_json(create_body),
+            image_url=_intern(fields.get("image_url")),
+            additional_images=tuple(_intern(url) for url in fields.get("additional_images") or ()),
+            category=_intern(fields.get("category")),
+            platform=_intern(fields.get("platform")),
+            upc=_intern(fields.get("upc")),
+        )
+
+    @property
+    def cost(self) -> int:
+        """Scheduling weight: one create plus one upload per photo."""
+        return 1 + (1 if self.image_url else 0) + len(self.additional_images)
+
+    def __repr__(self) -> str:
+        return f"QueuedListing({self.category}/{self.platform}/{self.upc}, {len(self.payload)} bytes)"
@@ -0,0 +1,207 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+from utils.auth import tenant_id_for
+
+# Adaptive per-account rate governor for Gameflip API calls.
+#
+# Each account gets a request rate and a concurrency limit that grow additively on
+# success and are halved on throttling (HTTP 429, a "Too many attempts" body, or a
+# Retry-After header), after which the account backs off for Retry-After or an
+# exponentially growing pause. Every route goes through it, so calls run close to the
+# real upstream limit instead of behind fixed sleeps.
+
+GOVERNOR_INITIAL_RATE = float(os.getenv("GOVERNOR_INITIAL_RATE", "5"))   # requests per second
+GOVERNOR_MIN_RATE = float(os.getenv("GOVERNOR_MIN_RATE", "0.5"))
+GOVERNOR_MAX_RATE = float(os.getenv("GOVERNOR_MAX_RATE", "30"))
+GOVERNOR_RATE_INCREASE = float(os.getenv("GOVERNOR_RATE_INCREASE", "0.5"))  # req/s gained per second of success
+GOVERNOR_INITIAL_CONCURRENCY = int(os.getenv("GOVERNOR_INITIAL_CONCURRENCY", "4"))
+GOVERNOR_MAX_CONCURRENCY = int(os.getenv("GOVERNOR_MAX_CONCURRENCY", "16"))
+GOVERNOR_DECREASE_FACTOR = 0.5
+GOVERNOR_BASE_BACKOFF = float(os.getenv("GOVERNOR_BASE_BACKOFF", "2"))
+GOVERNOR_MAX_BACKOFF = float(os.getenv("GOVERNOR_MAX_BACKOFF", "60"))
+GOVERNOR_DEFAULT_LATENCY = float(os.getenv("GOVERNOR_DEFAULT_LATENCY", "0.5"))  # seconds, until measured
+LATENCY_SMOOTHING = 0.2
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_throttled(status: Optional[int], body: Any = None, headers=None) -> bool:
+    """
+    A 429, a Retry-After on an error response, or a FAILURE body whose error message
+    says "Too many attempts". Successful bodies are never inspected, since listing
+    names and descriptions may contain any text.
+    """
+    if status == 429:
+        return True
+    if status is not None and not 200 <= status < 300 and headers and headers.get("Retry-After"):
+        return True
+    if isinstance(body, dict) and body.get("status") == "FAILURE":
+        error = body.get("error")
+        message = error.get("message") if isinstance(error, dict) else error
+        return "Too many attempts" in str(message or "")
+    return False
+
+
+class Permit:
+    """One governed request. Call record() with the response so the governor can adapt."""
+
+    def __init__(self, governor: "RateGovernor"):
+        self.governor = governor
+        self.recorded = False
+
+    def record(self, status: Optional[int], body: Any = None, headers=None) -> bool:
+        """Feed back the outcome; returns True if the response was a throttle."""
+        self.recorded = True
+        if is_throttled(status, body, headers):
+            self.governor.on_throttle(parse_retry_after(headers))
+            return True
+        if status is not None and status < 500:
+            self.governor.on_success()
+        return False
+
+
+class RateGovernor:
+    def __init__(self, name: str):
+        self.name = name
+        self.rate = GOVERNOR_INITIAL_RATE
+        self.limit = float(GOVERNOR_INITIAL_CONCURRENCY)
+        self.in_flight = 0
+        self.backoff_until = 0.0
+        self._next_slot = 0.0
+        self._last_decrease = 0.0
+        self._consecutive_throttles = 0
+        self._waiters: deque = deque()
+        self.latency: Optional[float] = None  # EWMA of request duration, seconds
+        self.stats = {"requests": 0, "throttled": 0, "decreases": 0}
+
+    # ---- admission ----
+    async def _acquire_concurrency(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        free = int(self.limit) - self.in_flight
+        for waiter in list(self._waiters)[:max(free, 0)]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def _await_rate(self):
+        while True:
+            now = time.monotonic()
+            start = max(now, self._next_slot, self.backoff_until)
+            if start <= now:
+                self._next_slot = now + 1.0 / self.rate
+                return
+            await asyncio.sleep(start - now)
+
+    async def acquire(self):
+        await self._acquire_concurrency()
+        try:
+            await self._await_rate()
+        except BaseException:
+            self._release()
+            raise
+        self.stats["requests"] += 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        started = time.monotonic()
+        try:
+            yield Permit(self)
+        finally:
+            self._observe_latency(time.monotonic() - started)
+            self._release()
+
+    def _observe_latency(self, seconds: float):
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_SMOOTHING * (seconds - self.latency)
+
+    def projected_seconds(self, calls: int, concurrency: int) -> float:
+        """Time `calls` requests would take at the current rate, limit and measured latency."""
+        if calls <= 0:
+            return 0.0
+        latency = self.latency if self.latency is not None else GOVERNOR_DEFAULT_LATENCY
+        parallel = max(1, min(concurrency, int(self.limit)))
+        throughput = min(self.rate, parallel / max(latency, 1e-3))
+        backoff = max(0.0, self.backoff_until - time.monotonic())
+        return backoff + calls / throughput
+
+    # ---- AIMD ----
+    def on_success(self):
+        self._consecutive_throttles = 0
+        self.rate = min(GOVERNOR_MAX_RATE, self.rate + GOVERNOR_RATE_INCREASE / self.rate)
+        self.limit = min(float(GOVERNOR_MAX_CONCURRENCY), self.limit + 1.0 / self.limit)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        now = time.monotonic()
+        self.stats["throttled"] += 1
+        self._consecutive_throttles += 1
+        # Requests already in flight when the limit was hit throttle together; cut once per burst
+        if now - self._last_decrease > 1.0 / self.rate + 1.0:
+            self.rate = max(GOVERNOR_MIN_RATE, self.rate * GOVERNOR_DECREASE_FACTOR)
+            self.limit = max(1.0, self.limit * GOVERNOR_DECREASE_FACTOR)
+            self._last_decrease = now
+            self.stats["decreases"] += 1
+        if retry_after is None:
+            retry_after = min(GOVERNOR_MAX_BACKOFF, GOVERNOR_BASE_BACKOFF * 2 ** (self._consecutive_throttles - 1))
+        self.backoff_until = max(self.backoff_until, now + retry_after)
+        logging.warning(f"Throttled upstream ({self.name}); rate {self.rate:.2f}/s, "
+                        f"concurrency {int(self.limit)}, backing off {retry_after:.1f}s")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "rate_per_second": round(self.rate, 3),
+            "concurrency_limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "backoff_remaining": round(max(0.0, self.backoff_until - time.monotonic()), 2),
+            "consecutive_throttles": self._consecutive_throttles,
+            "latency": round(self.latency, 4) if self.latency is not None else None,
+        }
+
+
+_governors: Dict[str, RateGovernor] = {}
+
+
+def get_governor(api_key: Optional[str]) -> RateGovernor:
+    """The governor of the account behind `api_key`."""
+    account = tenant_id_for(api_key or "")
+    governor = _governors.get(account)
+    if governor is None:
+        governor = RateGovernor(account)
+        _governors[account] = governor
+    return governor
+
+
+def get_governor_stats() -> Dict[str, Dict[str, Any]]:
+    return {account: governor.get_stats() for account, governor in _governors.items()}
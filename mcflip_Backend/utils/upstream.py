@@ -0,0 +1,236 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+from utils.auth import get_auth_headers, observe_server_time, otp_rejected, is_otp_error
+from utils.rate_governor import get_governor
+
+# Shared client for every Gameflip API call.
+#
+# One request path for all routers: rate governor slot, fresh OTP headers, then the
+# call. It retries by policy with jittered exponential backoff. A per-host circuit
+# breaker fails calls fast while the upstream is down, and every logical operation
+# has a total deadline. The outcome is always an UpstreamResult; each router decides
+# how to surface a failure (raise, None, ...).
+
+BASE_URL = os.getenv("BASE_URL", "https://production-gameflip.fingershock.com/api/v1")
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", "5"))
+UPSTREAM_BREAKER_RESET = float(os.getenv("UPSTREAM_BREAKER_RESET", "30"))
+
+Credentials = Tuple[Optional[str], Optional[str]]
+
+# Methods safe to resend after a failure that may have taken effect
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE"}
+
+
+class RetryPolicy:
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 deadline: float = 60.0, retry_server_errors: bool = True):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline                        # seconds for the whole operation
+        self.retry_server_errors = retry_server_errors  # retry 5xx / connection errors
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry number `attempt` (0-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+READ_POLICY = RetryPolicy(attempts=4, deadline=float(os.getenv("UPSTREAM_READ_DEADLINE", "30")))
+WRITE_POLICY = RetryPolicy(attempts=3, deadline=float(os.getenv("UPSTREAM_WRITE_DEADLINE", "60")))
+
+
+class UpstreamResult:
+    def __init__(self, ok: bool, status: Optional[int] = None, data: Any = None,
+                 error: Optional[str] = None, attempts: int = 0):
+        self.ok = ok
+        self.status = status      # HTTP status of the last response, None if there was none
+        self.data = data          # decoded JSON body of the last response
+        self.error = error        # "http", "otp", "throttled", "unavailable", "circuit_open", "deadline"
+        self.attempts = attempts
+
+    @property
+    def message(self) -> str:
+        if isinstance(self.data, dict):
+            message = (self.data.get("error") or {}).get("message")
+            if message:
+                return message
+        return self.error or "Unknown error"
+
+    def __repr__(self) -> str:
+        return f"UpstreamResult(ok={self.ok}, status={self.status}, error={self.error}, attempts={self.attempts})"
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures; after `reset_timeout` lets one trial call through."""
+
+    def __init__(self, host: str, failure_threshold: int = UPSTREAM_BREAKER_FAILURES,
+                 reset_timeout: float = UPSTREAM_BREAKER_RESET):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self.stats = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        self.stats["rejected"] += 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def abandon(self):
+        """The call was cancelled before it had an outcome."""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        reopen = self._trial_in_flight
+        self._trial_in_flight = False
+        if reopen or (self.opened_at is None and self.failures >= self.failure_threshold):
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+            logging.error(f"Circuit to {self.host} opened after {self.failures} failures")
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**self.stats, "state": self.state, "failures": self.failures}
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(url: str) -> CircuitBreaker:
+    host = urlsplit(url).netloc
+    breaker = _breakers.get(host)
+    if breaker is None:
+        breaker = CircuitBreaker(host)
+        _breakers[host] = breaker
+    return breaker
+
+
+def get_breaker_stats() -> Dict[str, Dict[str, Any]]:
+    return {host: breaker.get_stats() for host, breaker in _breakers.items()}
+
+
+async def _decode(response) -> Any:
+    try:
+        return await response.json(content_type=None)
+    except Exception:
+        return {"error": {"message": (await response.text())[:500]}}
+
+
+def _body_ok(status: int, data: Any) -> bool:
+    return 200 <= status < 300 and not (isinstance(data, dict) and data.get("status") == "FAILURE")
+
+
+async def _attempts(session, method: str, url: str, creds: Credentials, content_type: str,
+                    policy: RetryPolicy, breaker: CircuitBreaker, request_kwargs: Dict[str, Any],
+                    result: UpstreamResult) -> UpstreamResult:
+    api_key, api_secret = creds
+    # A POST that failed in flight or with a 5xx may still have created something, so
+    # it is only retried when the upstream clearly refused it (throttle, rejected OTP)
+    retry_failures = policy.retry_server_errors and method in IDEMPOTENT_METHODS
+    otp_retry = 0
+    for attempt in range(policy.attempts):
+        result.attempts = attempt + 1
+        if not breaker.allow():
+            result.ok, result.error = False, "circuit_open"
+            return result
+        try:
+            async with get_governor(api_key).slot() as permit:
+                headers = get_auth_headers(api_key, api_secret, content_type, attempt=otp_retry)
+                async with session.request(method, url, headers=headers, **request_kwargs) as response:
+                    observe_server_time(response.headers)
+                    data = await _decode(response)
+                    result.status, result.data = response.status, data
+                    throttled = permit.record(response.status, data, response.headers)
+        except asyncio.CancelledError:
+            breaker.abandon()
+            raise
+        except Exception as e:
+            logging.error(f"Upstream {method} {url} failed: {str(e)} (Attempt {attempt + 1}/{policy.attempts})")
+            breaker.record_failure()
+            result.ok, result.error, result.data = False, "unavailable", {"error": {"message": str(e)}}
+            if not retry_failures:
+                return result
+            if attempt < policy.attempts - 1:
+                await asyncio.sleep(policy.backoff(attempt))
+            continue
+
+        if response.status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+        if _body_ok(response.status, data):
+            result.ok, result.error = True, None
+            return result
+        if throttled:
+            # The governor holds the account back before the next slot
+            result.ok, result.error = False, "throttled"
+            continue
+        if is_otp_error(data):
+            otp_rejected(api_key, api_secret, headers["Authorization"].rsplit(":", 1)[-1])
+            otp_retry += 1
+            result.ok, result.error = False, "otp"
+            continue
+        if response.status >= 500:
+            result.ok, result.error = False, "unavailable"
+            if not retry_failures:
+                return result
+            if attempt < policy.attempts - 1:
+                await asyncio.sleep(policy.backoff(attempt))
+            continue
+        result.ok, result.error = False, "http"
+        return result
+    return result
+
+
+async def upstream_request(session, method: str, url: str, creds: Credentials,
+                           content_type: str = "application/json", policy: Optional[RetryPolicy] = None,
+                           **request_kwargs) -> UpstreamResult:
+    """
+    Call the Gameflip API with `creds` = (api_key, api_secret). `url` may be a path
+    relative to BASE_URL. Extra keyword arguments (params, json, data) go to aiohttp.
+    GETs use READ_POLICY and everything else WRITE_POLICY unless `policy` is given.
+    POSTs are not resent after a connection error or 5xx, only after a throttle or a
+    rejected OTP.
+    """
+    method = method.upper()
+    if url.startswith("/"):
+        url = BASE_URL + url
+    if policy is None:
+        policy = READ_POLICY if method == "GET" else WRITE_POLICY
+    breaker = get_breaker(url)
+    result = UpstreamResult(ok=False)
+    try:
+        return await asyncio.wait_for(
+            _attempts(session, method, url, creds, content_type, policy, breaker, request_kwargs, result),
+            timeout=policy.deadline,
+        )
+    except asyncio.TimeoutError:
+        logging.error(f"Upstream {method} {url} exceeded its {policy.deadline:.0f}s deadline")
+        result.ok, result.error = False, "deadline"
+        return result